@@ -3,6 +3,8 @@ import regex as re
 from typing import Dict, List, Tuple
 from collections import Counter
 
+from cs336_basics.chunking import plan_chunks, reduce_chunks
+
 # GPT-2 的预分词正则表达式
 GPT2_SPLIT_PATTERN = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
 
@@ -10,28 +12,35 @@ def train_bpe(
     input_path: str | os.PathLike,
     vocab_size: int,
     special_tokens: list[str],
+    num_processes: int = 1,
     **kwargs,
 ) -> tuple[dict[int, bytes], list[tuple[bytes, bytes]]]:
     """
     Given the path to an input corpus, run train a BPE tokenizer and
     output its vocabulary and merges.
+
+    num_processes > 1 时，文件在特殊 token 处被切成许多小块，由进程池并行预分词计数后合并。
     """
     
-    # ==========================================
-    # 1. 数据加载
-    # ==========================================
-    # TODO: 读取 input_path 对应的文件内容
-    # 提示: 使用 open(input_path, "r", encoding="utf-8")
-    with open(input_path, "r", encoding="utf-8") as file:
-        text = file.read()
-    # print("ZHANG --------- "+text[:10])
-    
-    # ==========================================
-    # 2. 预处理 (Pre-tokenization)
-    # ==========================================
-    # TODO: 实现 _pretokenize_and_count 函数
-    # 提示：务必先处理 special_tokens，再进行正则切分
-    word_counts = _pretokenize_and_count(text, special_tokens)
+    if num_processes > 1 and special_tokens:
+        # 1+2. 并行地加载与预处理，每个 worker 只读取自己负责的字节区间
+        word_counts = _parallel_pretokenize_and_count(input_path, special_tokens, num_processes)
+    else:
+        # ==========================================
+        # 1. 数据加载
+        # ==========================================
+        # TODO: 读取 input_path 对应的文件内容
+        # 提示: 使用 open(input_path, "r", encoding="utf-8")
+        with open(input_path, "r", encoding="utf-8") as file:
+            text = file.read()
+        # print("ZHANG --------- "+text[:10])
+
+        # ==========================================
+        # 2. 预处理 (Pre-tokenization)
+        # ==========================================
+        # TODO: 实现 _pretokenize_and_count 函数
+        # 提示：务必先处理 special_tokens，再进行正则切分
+        word_counts = _pretokenize_and_count(text, special_tokens)
     # print("first time")
     # for word, freq in word_counts.items():
     #     print(f"{word}, {freq}\n")
@@ -140,6 +149,34 @@ def _pretokenize_and_count(text: str, special_tokens: list[str]) -> Counter[tupl
     
     return counts
 
+def _parallel_pretokenize_and_count(
+    input_path: str | os.PathLike, special_tokens: list[str], num_processes: int
+) -> Counter[tuple[int, ...]]:
+    """
+    把文件在特殊 token 的起点处过度切分为许多小块，空闲的 worker 依次领取，各块的计数按完成顺序相加。
+    特殊 token 会切断预分词，因此在这些位置切分不改变计数结果
+    （落在更长的、与之重叠的特殊 token 内部的位置不会被选为边界，见 chunking.find_chunk_boundaries）。
+    """
+    input_path = os.fspath(input_path)
+    chunks = plan_chunks(input_path, num_processes, [token.encode("utf-8") for token in special_tokens])
+    tasks = [(input_path, start, end, special_tokens) for start, end in chunks]
+    counts = reduce_chunks(_count_chunk, tasks, num_processes, initial=Counter())
+    return counts if counts is not None else Counter()
+
+
+def _count_chunk(task: tuple[str, int, int, list[str]]) -> Counter[tuple[int, ...]]:
+    """
+    读取文件中的 [start, end) 字节区间并预分词计数。
+    """
+    input_path, start, end, special_tokens = task
+    with open(input_path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+    # 和整体读取时一致：文本模式的 open 会把 \r\n 转换为 \n
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return _pretokenize_and_count(text, special_tokens)
+
+
 def _get_pair_stats(word_counts: Counter[tuple[int, ...]]) -> Dict[tuple[int, int], int]:
     """
     统计当前所有单词中相邻 token 对的出现频率。
@@ -0,0 +1,222 @@
+import math
+import mmap
+import multiprocessing as mp
+import operator
+import os
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from typing import BinaryIO, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# 在目标位置附近搜索分隔符时，默认允许偏离平均块大小的比例
+DEFAULT_TOLERANCE = 0.1
+
+# 过度切分时每个进程平均分到的任务数
+DEFAULT_TASKS_PER_PROCESS = 8
+
+
+def find_chunk_boundaries(
+    file: BinaryIO | str | os.PathLike,
+    desired_num_chunks: int,
+    split_special_tokens: bytes | Sequence[bytes],
+    tolerance: float = DEFAULT_TOLERANCE,
+    special_tokens: Sequence[bytes] | None = None,
+) -> list[int]:
+    """
+    把文件切分为可以独立处理的若干块，每个内部边界都落在某个分隔符的起点上。
+
+    特殊 token 之间可能重叠（例如 "<|endoftext|>" 和 "<|endoftext|><|endoftext|>"），
+    这时分隔符的起点可能落在一个更长的特殊 token 内部，在那里切分会改变编码结果。
+    因此边界还必须不在任何特殊 token 的出现位置内部（不论这个出现位置最终是否被匹配，判断偏保守）：
+    满足这一条件时，从文件开头的最长匹配扫描一定恰好在边界处开始一个新的匹配，各块可以独立编码。
+
+    和 pretokenization_example.find_chunk_boundaries 相比：
+    - 在文件的 mmap 视图上用 find/rfind 搜索，跨越 4KB 读块的分隔符不会被漏掉；
+    - 支持多个分隔符，取离目标位置最近的那个；
+    - 边界依次确定，每个目标位置都按剩余字节重新均分，并在目标前后两个方向上找最近的分隔符。
+      只要目标附近 tolerance * 平均块大小 的范围内有分隔符，块大小就不会偏离太多；
+      边界不会重合，只有分隔符不够多时才会少于 desired_num_chunks 块。
+
+    Args:
+        file: 以二进制方式打开的文件，或文件路径
+        desired_num_chunks: 期望的块数
+        split_special_tokens: 一个或多个分隔符（bytes）
+        tolerance: 优先在目标位置 ± tolerance * 平均块大小 的范围内寻找分隔符
+        special_tokens: 所有特殊 token（bytes），边界不能落在它们内部；默认为 split_special_tokens
+
+    Returns:
+        递增的边界列表，首项为 0、末项为文件大小；块 i 为 [boundaries[i], boundaries[i + 1])
+    """
+    if isinstance(split_special_tokens, bytes):
+        split_special_tokens = [split_special_tokens]
+    tokens = [token for token in split_special_tokens if token]
+    guards = tokens if special_tokens is None else [token for token in special_tokens if token]
+    if not all(isinstance(token, bytes) for token in tokens + guards):
+        raise TypeError("split_special_tokens and special_tokens must be bytes")
+    if desired_num_chunks < 1:
+        raise ValueError(f"desired_num_chunks must be positive, got {desired_num_chunks}")
+
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as f:
+            return find_chunk_boundaries(f, desired_num_chunks, tokens, tolerance, guards)
+
+    file_size = os.fstat(file.fileno()).st_size
+    if file_size == 0:
+        return [0]
+    if not tokens or desired_num_chunks == 1:
+        return [0, file_size]
+
+    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        slack = max(1, int(tolerance * file_size / desired_num_chunks))
+        boundaries = [0]
+        for i in range(1, desired_num_chunks):
+            previous = boundaries[-1]
+            target = previous + (file_size - previous) // (desired_num_chunks - i + 1)
+            # 先在目标附近的窗口内找，找不到再放开到 (previous, file_size)
+            low = max(previous + 1, target - slack)
+            position = _nearest_delimiter(view, tokens, guards, target, low, target + slack)
+            if position is None:
+                position = _nearest_delimiter(view, tokens, guards, target, previous + 1, file_size)
+            if position is None:
+                break
+            boundaries.append(position)
+        boundaries.append(file_size)
+    return boundaries
+
+
+def _nearest_delimiter(
+    view: mmap.mmap, tokens: Sequence[bytes], guards: Sequence[bytes], target: int, low: int, high: int
+) -> int | None:
+    """
+    返回起点在 [low, high) 内、不在 guards 中任何 token 内部、离 target 最近的分隔符起点（距离相同时取靠前的），
+    没有则返回 None。
+    """
+    high = min(high, len(view))
+    best = None
+    for token in tokens:
+        candidates = []
+        # rfind 要求整个匹配落在 [start, end) 内，起点 < 上界 即 end = 上界 + len - 1
+        end = min(target, high)
+        while low < end:
+            before = view.rfind(token, low, end + len(token) - 1)
+            if before == -1:
+                break
+            if not _inside_token(view, guards, before):
+                candidates.append(before)
+                break
+            end = before
+        start = max(target, low)
+        while start < high:
+            after = view.find(token, start, high + len(token) - 1)
+            if after == -1:
+                break
+            if not _inside_token(view, guards, after):
+                candidates.append(after)
+                break
+            start = after + 1
+        for position in candidates:
+            if best is None or (abs(position - target), position) < (abs(best - target), best):
+                best = position
+    return best
+
+
+def _inside_token(view: mmap.mmap, guards: Sequence[bytes], position: int) -> bool:
+    """
+    判断 guards 中是否有某个 token 的出现位置跨过 position（起点在 position 之前、终点在 position 之后）。
+    """
+    for token in guards:
+        # 起点在 [position - len + 1, position) 内的出现位置都跨过 position，find 要求匹配在 end 之前结束
+        window_start = max(position - len(token) + 1, 0)
+        if window_start < position and view.find(token, window_start, position + len(token) - 1) != -1:
+            return True
+    return False
+
+
+def plan_chunks(
+    file: BinaryIO | str | os.PathLike,
+    num_processes: int,
+    split_special_tokens: bytes | Sequence[bytes],
+    tasks_per_process: int = DEFAULT_TASKS_PER_PROCESS,
+    max_chunk_size: int | None = None,
+    special_tokens: Sequence[bytes] | None = None,
+) -> list[tuple[int, int]]:
+    """
+    把文件过度切分为远多于进程数的小任务，返回按文件顺序排列的 [start, end) 字节区间。
+
+    只切成 num_processes 块时，预分词代价高的块会拖住整个任务，其余进程空等；
+    切成 num_processes * tasks_per_process 个小块后，空闲的进程随时可以领取下一块（见 map_chunks）。
+
+    Args:
+        file: 以二进制方式打开的文件，或文件路径
+        num_processes: worker 进程数
+        split_special_tokens: 一个或多个分隔符，任务边界只落在分隔符的起点上
+        tasks_per_process: 每个进程平均分到的任务数
+        max_chunk_size: 单个任务的最大目标字节数，用于限制 worker 的峰值内存
+        special_tokens: 所有特殊 token，任务边界不能落在它们内部（见 find_chunk_boundaries）
+
+    Returns:
+        任务区间列表，空文件返回空列表
+    """
+    if isinstance(file, (str, os.PathLike)):
+        file_size = os.path.getsize(file)
+    else:
+        file_size = os.fstat(file.fileno()).st_size
+    desired_num_chunks = max(1, num_processes * tasks_per_process)
+    if max_chunk_size:
+        desired_num_chunks = max(desired_num_chunks, math.ceil(file_size / max_chunk_size))
+    boundaries = find_chunk_boundaries(file, desired_num_chunks, split_special_tokens, special_tokens=special_tokens)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def map_chunks(
+    fn: Callable[[T], R],
+    tasks: Iterable[T],
+    num_processes: int,
+    initializer: Callable[..., None] | None = None,
+    initargs: tuple = (),
+    ordered: bool = True,
+) -> Iterator[R]:
+    """
+    在进程池中对每个任务调用 fn，逐个产出结果。
+
+    任务放在进程池共享的队列里，每次只分发一个（chunksize=1），先空闲下来的进程先领取下一个任务，
+    慢任务不会让其余进程闲置。ordered=True 时按任务顺序产出（适合需要按原顺序拼接的 token 文件），
+    否则按完成顺序产出（适合可交换的归约，见 reduce_chunks）。num_processes <= 1 时在当前进程中依次执行。
+
+    Args:
+        fn: 处理单个任务的函数，需要可以被 pickle（模块级函数）
+        tasks: 任务列表
+        num_processes: worker 进程数
+        initializer: 每个 worker 启动时调用一次，用于传递只读的大对象（如 tokenizer）
+        initargs: initializer 的参数
+        ordered: 是否按任务顺序产出结果
+    """
+    if num_processes <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(fn, tasks)
+        return
+    with mp.Pool(num_processes, initializer=initializer, initargs=initargs) as pool:
+        results = pool.imap(fn, tasks, chunksize=1) if ordered else pool.imap_unordered(fn, tasks, chunksize=1)
+        yield from results
+
+
+def reduce_chunks(
+    fn: Callable[[T], R],
+    tasks: Iterable[T],
+    num_processes: int,
+    combine: Callable[[R, R], R] = operator.iadd,
+    initial: R | None = None,
+    initializer: Callable[..., None] | None = None,
+    initargs: tuple = (),
+) -> R | None:
+    """
+    并行地对每个任务调用 fn，并在结果完成时立即用 combine 归约（如把各块的 Counter 相加）。
+
+    combine 必须满足交换律和结合律，因为结果按完成顺序到达。没有任务时返回 initial。
+    """
+    result = initial
+    for partial in map_chunks(fn, tasks, num_processes, initializer, initargs, ordered=False):
+        result = partial if result is None else combine(result, partial)
+    return result
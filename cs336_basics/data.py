@@ -0,0 +1,737 @@
+import json
+import os
+import queue
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator, Sequence
+from typing import Any, NamedTuple
+
+import numpy as np
+import numpy.typing as npt
+import torch
+from numpy.lib.stride_tricks import sliding_window_view
+
+from cs336_basics.token_shard import check_shard, open_shard, read_shard_header
+
+# torch 不一定支持的无符号类型，拷贝到 torch 之前先在主机上扩宽
+_TORCH_COMPATIBLE_DTYPE = {np.dtype(np.uint16): np.int32, np.dtype(np.uint32): np.int64}
+
+# 扫描文档边界时每次读入的 token 数，限制 memmap 上临时数组的大小
+_SCAN_BLOCK_SIZE = 1 << 24
+
+
+def load_tokens(
+    path: str | os.PathLike, dtype: npt.DTypeLike = np.uint16, fingerprint: bytes | None = None
+) -> np.ndarray:
+    """
+    以只读 np.memmap 的方式打开 token 文件，不把数据读入内存。
+
+    token_shard 格式的文件（encode_file 的输出）由文件头决定 dtype，给定 fingerprint
+    （Tokenizer.fingerprint()）时与头部记录的 tokenizer 不一致会抛出 ValueError；
+    以 .npy 结尾的文件按 npy 格式打开；其余文件视为 dtype 的原始数组，无法检查 fingerprint。
+    """
+    if read_shard_header(path) is not None:
+        return open_shard(path, fingerprint)[0]
+    if fingerprint is not None:
+        raise ValueError(f"{path} has no shard header, so its tokenizer cannot be checked")
+    if os.fspath(path).endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+def load_document_starts(path: str | os.PathLike, eot_token_id: int, dtype: npt.DTypeLike = np.uint16) -> np.ndarray:
+    """
+    返回 token 文件中每个文档的起点（见 document_starts）。token_shard 格式的文件直接映射其中保存的文档索引，
+    其余文件需要扫描一遍。
+    """
+    header = read_shard_header(path)
+    if header is not None:
+        if header.eot_token_id != eot_token_id:
+            raise ValueError(f"{path} indexes documents ending with token {header.eot_token_id}, not {eot_token_id}")
+        return open_shard(path)[1]
+    return document_starts(load_tokens(path, dtype), eot_token_id)
+
+
+def num_tokens_in_file(path: str | os.PathLike, dtype: npt.DTypeLike = np.uint16) -> int:
+    """
+    不映射文件，只根据文件头或文件大小得到 load_tokens(path, dtype) 的长度。
+    """
+    header = read_shard_header(path)
+    if header is not None:
+        return header.num_tokens
+    if os.fspath(path).endswith(".npy"):
+        with open(path, "rb") as f:
+            major, _ = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if major == 1 else np.lib.format.read_array_header_2_0
+            shape, _, _ = read_header(f)
+        return int(np.prod(shape))
+    return os.path.getsize(path) // np.dtype(dtype).itemsize
+
+
+def get_batch(
+    dataset: npt.NDArray,
+    batch_size: int,
+    context_length: int,
+    device: str | torch.device,
+    rng: np.random.Generator | None = None,
+    sampler: "BatchSampler | None" = None,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    从一维 token 数组中均匀随机地采样 batch_size 个长度为 context_length + 1 的窗口，
+    返回语言模型的输入 x 和标签 y（y 为 x 右移一位），形状均为 (batch_size, context_length)。
+
+    dataset 可以是比内存大得多的 np.memmap：在它上面建立 (N - context_length, context_length + 1)
+    的滑动窗口视图（只改 strides，不拷贝），再用一次花式索引取出所有窗口，只有被采到的页会被读入。
+    x 和 y 是同一个 (batch_size, context_length + 1) 张量的两个切片，整个 batch 只做一次主机到设备的拷贝，
+    转换为 int64 也在设备上完成。
+
+    Args:
+        dataset: 一维整数 token 数组
+        batch_size: batch 大小
+        context_length: 每个样本的长度
+        device: PyTorch 设备字符串，如 "cpu" 或 "cuda:0"
+        rng: 随机数生成器，默认使用一个新的未设定种子的生成器
+        sampler: 可复现、可断点续训的窗口起点采样器，给定时忽略 rng
+
+    Returns:
+        (x, y)，均为 torch.long 张量
+    """
+    starts = _sample_starts(len(dataset), batch_size, context_length, rng, sampler)
+    windows = sliding_window_view(dataset, context_length + 1)
+    return _windows_to_device(windows[starts], device)
+
+
+def _sample_starts(
+    num_tokens: int,
+    batch_size: int,
+    context_length: int,
+    rng: np.random.Generator | None,
+    sampler: "BatchSampler | None",
+) -> np.ndarray:
+    if num_tokens <= context_length:
+        raise ValueError(f"dataset of length {num_tokens} is too short for context_length {context_length}")
+    if sampler is not None:
+        return sampler.next_starts(batch_size, context_length)
+    rng = rng if rng is not None else np.random.default_rng()
+    return rng.integers(0, num_tokens - context_length, size=batch_size)
+
+
+def _windows_to_device(windows: np.ndarray, device: str | torch.device) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    把 (batch, context_length + 1) 的窗口数组拷贝到 device，拆分为 x 和 y。
+    """
+    compatible = _TORCH_COMPATIBLE_DTYPE.get(windows.dtype)
+    if compatible is not None:
+        windows = windows.astype(compatible)
+    tokens = torch.from_numpy(windows).to(device).long()
+    return tokens[:, :-1], tokens[:, 1:]
+
+
+class BatchSampler:
+    """
+    可复现、可断点续训的窗口起点采样器。
+
+    - 随机模式（shuffle=False）：第 step 个 batch 的起点由 np.random.default_rng([seed, step]) 独立地均匀采样，
+      只依赖 (seed, step)，与之前采过什么无关。
+    - 洗牌模式（shuffle=True）：候选起点（槽）为 0, stride, 2 * stride, ...（stride 默认为 context_length，
+      即互不重叠的窗口）。每个 epoch 按 default_rng([seed, epoch]) 的随机排列无放回地遍历一遍，
+      一个 batch 可以跨越 epoch 边界。
+      next_starts 给出比构造时更短的 context_length 时（如 TokenBudgetSchedule 的短序列阶段），
+      每个槽被切成若干个首尾相接的该长度窗口依次产出，没用完的槽留给下一个 batch，
+      因此短序列步同样无放回地覆盖每个槽的全部 token。
+
+    状态只有已产出的 batch 数 step、已取出的样本（槽）数 samples_seen 和当前槽已用掉的 token 数 slot_offset，
+    state_dict() 可以直接存进训练 checkpoint；load_state_dict() 之后产出的起点序列和不中断时完全一致，
+    不会重放已经用过的样本。
+    """
+
+    def __init__(
+        self,
+        num_tokens: int,
+        context_length: int,
+        seed: int = 0,
+        shuffle: bool = False,
+        stride: int | None = None,
+    ):
+        if num_tokens <= context_length:
+            raise ValueError(f"dataset of length {num_tokens} is too short for context_length {context_length}")
+        self.num_starts = num_tokens - context_length
+        self.context_length = context_length
+        self.seed = seed
+        self.shuffle = shuffle
+        self.stride = stride or context_length
+        self.step = 0
+        self.samples_seen = 0
+        self.slot_offset = 0
+        self._permutation: tuple[int, np.ndarray] | None = None
+
+    @classmethod
+    def over_indices(cls, num_indices: int, seed: int = 0, shuffle: bool = False) -> "BatchSampler":
+        """
+        采样 [0, num_indices) 中的下标而不是窗口起点，用于从预先算好的候选样本中采样（如 packed_row_starts）。
+        """
+        return cls(num_indices, 0, seed=seed, shuffle=shuffle, stride=1)
+
+    @property
+    def epoch_size(self) -> int:
+        """
+        洗牌模式下每个 epoch 的样本数。
+        """
+        return -(-self.num_starts // self.stride)
+
+    @property
+    def epoch(self) -> int:
+        return self.samples_seen // self.epoch_size if self.shuffle else 0
+
+    def next_starts(self, batch_size: int, context_length: int | None = None) -> np.ndarray:
+        """
+        返回下一个 batch 的 batch_size 个窗口起点，并推进状态。
+
+        Args:
+            batch_size: 起点个数
+            context_length: 这一步的窗口长度，默认为构造时的 context_length，不能更长
+
+        Returns:
+            int64 起点数组
+        """
+        if context_length is None:
+            context_length = self.context_length
+        elif not 0 < context_length <= self.context_length:
+            raise ValueError(
+                f"context_length must be in [1, {self.context_length}] for this sampler, got {context_length}"
+            )
+        if self.shuffle:
+            starts = self._consecutive_starts(batch_size, context_length)
+        else:
+            starts = np.random.default_rng([self.seed, self.step]).integers(0, self.num_starts, size=batch_size)
+            self.samples_seen += batch_size
+        self.step += 1
+        return starts
+
+    def _consecutive_starts(self, batch_size: int, context_length: int) -> np.ndarray:
+        """
+        洗牌模式：把每个槽切成首尾相接的 context_length 窗口，先用完上一步剩下的槽，再按排列取新槽。
+        """
+        # 每个槽新增的 token 数（stride 大于 context_length 时，槽之间的 token 不会被采到）
+        # over_indices 的采样器 context_length 为 0，每个槽就是一个下标
+        span = min(self.stride, self.context_length) if self.context_length > 0 else 1
+        width = max(context_length, 1)
+        per_slot = max(span // width, 1)
+
+        parts = [np.zeros(0, dtype=np.int64)]
+        if self.slot_offset and self.samples_seen:
+            take = min(max((span - self.slot_offset) // width, 0), batch_size)
+            base = self._slot_starts(np.array([self.samples_seen - 1]))[0] + self.slot_offset
+            parts.append(base + width * np.arange(take, dtype=np.int64))
+            self.slot_offset += take * width
+            batch_size -= take
+
+        if batch_size > 0:
+            num_slots = -(-batch_size // per_slot)
+            slots = self._slot_starts(self.samples_seen + np.arange(num_slots))
+            parts.append((slots[:, None] + width * np.arange(per_slot, dtype=np.int64)).ravel()[:batch_size])
+            self.samples_seen += num_slots
+            self.slot_offset = (batch_size - (num_slots - 1) * per_slot) * width
+        return np.concatenate(parts)
+
+    def _slot_starts(self, positions: np.ndarray) -> np.ndarray:
+        """
+        洗牌模式下第 positions 个样本（可以跨越 epoch）对应的槽起点。
+        """
+        epochs, offsets = np.divmod(positions, self.epoch_size)
+        starts = np.empty(len(positions), dtype=np.int64)
+        for epoch in np.unique(epochs).tolist():
+            in_epoch = epochs == epoch
+            starts[in_epoch] = self._epoch_permutation(epoch)[offsets[in_epoch]] * self.stride
+        return starts
+
+    def _epoch_permutation(self, epoch: int) -> np.ndarray:
+        # 只缓存当前 epoch 的排列
+        if self._permutation is None or self._permutation[0] != epoch:
+            self._permutation = (epoch, np.random.default_rng([self.seed, epoch]).permutation(self.epoch_size))
+        return self._permutation[1]
+
+    def state_dict(self) -> dict[str, Any]:
+        return {
+            "num_starts": self.num_starts,
+            "seed": self.seed,
+            "shuffle": self.shuffle,
+            "stride": self.stride,
+            "step": self.step,
+            "samples_seen": self.samples_seen,
+            "slot_offset": self.slot_offset,
+        }
+
+    def load_state_dict(self, state_dict: dict[str, Any]) -> None:
+        """
+        恢复 state_dict() 保存的状态。数据集大小或 context_length 与保存时不同会被拒绝。
+        """
+        if state_dict["num_starts"] != self.num_starts:
+            raise ValueError(
+                f"sampler state was saved for {state_dict['num_starts']} window starts, "
+                f"but this dataset has {self.num_starts}"
+            )
+        self.seed = state_dict["seed"]
+        self.shuffle = state_dict["shuffle"]
+        self.stride = state_dict["stride"]
+        self.step = state_dict["step"]
+        self.samples_seen = state_dict["samples_seen"]
+        self.slot_offset = state_dict.get("slot_offset", 0)
+        self._permutation = None
+
+
+class BatchPrefetcher:
+    """
+    在后台线程中预先采样 batch，并提前把下一个 batch 拷贝到设备上，使数据加载不占用训练步的时间。
+
+    后台线程把采到的窗口写入 num_buffers 个预分配的主机缓冲区（device 为 CUDA 时使用 pinned memory），
+    写好的缓冲区编号放进有界队列；缓冲区在其内容拷贝到设备后才被放回空闲队列，整个过程不再分配主机内存。
+    每次取出一个 batch 时，都会在独立的 CUDA stream 上以 non_blocking 的方式发起下一个 batch 的拷贝，
+    这样拷贝和当前训练步的计算重叠。采样方式和 get_batch 相同，给定相同的 rng 或 sampler 时产出相同的 batch 序列。
+
+    使用 sampler 时，后台线程会提前推进它的状态；state_dict() 返回的是最后一个被取走的 batch 之后的采样器状态，
+    用它恢复的 BatchSampler 会从下一个未被消费的 batch 继续。
+
+    用法：
+
+        with BatchPrefetcher(dataset, batch_size, context_length, "cuda") as batches:
+            for step in range(num_steps):
+                x, y = next(batches)
+    """
+
+    def __init__(
+        self,
+        dataset: npt.NDArray,
+        batch_size: int,
+        context_length: int,
+        device: str | torch.device,
+        rng: np.random.Generator | None = None,
+        num_buffers: int = 4,
+        pin_memory: bool | None = None,
+        sampler: BatchSampler | None = None,
+    ):
+        if len(dataset) <= context_length:
+            raise ValueError(f"dataset of length {len(dataset)} is too short for context_length {context_length}")
+        if num_buffers < 2:
+            # 一个缓冲区在等待拷贝完成时，后台线程需要另一个缓冲区来写下一个 batch
+            raise ValueError(f"num_buffers must be at least 2, got {num_buffers}")
+        self.batch_size = batch_size
+        self.context_length = context_length
+        self.device = torch.device(device)
+        self._rng = rng if rng is not None else np.random.default_rng()
+        self._sampler = sampler
+        self._num_starts = len(dataset) - context_length
+        self._windows = sliding_window_view(dataset, context_length + 1)
+
+        if pin_memory is None:
+            pin_memory = self.device.type == "cuda"
+        host_dtype = _TORCH_COMPATIBLE_DTYPE.get(np.dtype(dataset.dtype), dataset.dtype)
+        self._host = []
+        for _ in range(num_buffers):
+            buffer = torch.from_numpy(np.empty((batch_size, context_length + 1), dtype=host_dtype))
+            self._host.append(buffer.pin_memory() if pin_memory else buffer)
+        self._stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+        # _free: 可以写入的缓冲区；_ready: 已写好的 (缓冲区编号, 采样器状态)，或后台线程抛出的异常
+        self._free: queue.Queue = queue.Queue()
+        self._ready: queue.Queue = queue.Queue()
+        for index in range(num_buffers):
+            self._free.put(index)
+        self._pending = None
+        self._state = sampler.state_dict() if sampler is not None else None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, name="batch-prefetcher", daemon=True)
+        self._thread.start()
+
+    def _fill(self) -> None:
+        while not self._stop.is_set():
+            try:
+                index = self._free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                if self._sampler is not None:
+                    starts = self._sampler.next_starts(self.batch_size, self.context_length)
+                    state = self._sampler.state_dict()
+                else:
+                    starts = self._rng.integers(0, self._num_starts, size=self.batch_size)
+                    state = None
+                self._host[index].numpy()[...] = self._windows[starts]
+            except BaseException as e:
+                self._ready.put(e)
+                return
+            self._ready.put((index, state))
+
+    def _transfer(self) -> tuple[int | None, torch.Tensor, torch.cuda.Event | None, dict[str, Any] | None]:
+        """
+        取出一个写好的缓冲区，发起到设备的拷贝，返回 (缓冲区编号, 设备上的张量, 拷贝完成的事件, 采样器状态)。
+        不需要等待拷贝完成的缓冲区（CPU 上的拷贝是同步的）立即放回空闲队列，编号返回 None。
+        """
+        item = self._ready.get()
+        if isinstance(item, BaseException):
+            raise item
+        index, state = item
+        host = self._host[index]
+        if self._stream is None:
+            tokens = host.to(self.device, dtype=torch.long, copy=True)
+            self._free.put(index)
+            return None, tokens, None, state
+        with torch.cuda.stream(self._stream):
+            tokens = host.to(self.device, non_blocking=True).long()
+            event = torch.cuda.Event()
+            event.record(self._stream)
+        return index, tokens, event, state
+
+    def __iter__(self) -> Iterator[tuple[torch.Tensor, torch.Tensor]]:
+        return self
+
+    def __next__(self) -> tuple[torch.Tensor, torch.Tensor]:
+        if self._pending is None:
+            self._pending = self._transfer()
+        index, tokens, event, self._state = self._pending
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            tokens.record_stream(stream)
+        # 先发起下一个 batch 的拷贝，它会和调用方接下来的计算重叠
+        self._pending = self._transfer()
+        if index is not None:
+            # 只有异步拷贝的缓冲区编号不为 None，它一定带有拷贝完成的事件
+            assert event is not None
+            event.synchronize()
+            self._free.put(index)
+        return tokens[:, :-1], tokens[:, 1:]
+
+    def state_dict(self) -> dict[str, Any] | None:
+        """
+        最后一个被取走的 batch 之后的采样器状态，没有 sampler 时为 None。
+        """
+        return self._state
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self) -> "BatchPrefetcher":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def document_starts(dataset: npt.NDArray, eot_token_id: int) -> np.ndarray:
+    """
+    扫描一遍 token 数组，返回每个文档的起点（int64，首项为 0）。每个文档包含结尾的 EOT token，
+    EOT 之后的 token 开始一个新文档。对 memmap 按块扫描，不会把整个数组读入内存。
+    """
+    starts = [np.zeros(1, dtype=np.int64)]
+    for offset in range(0, len(dataset), _SCAN_BLOCK_SIZE):
+        block = np.asarray(dataset[offset : offset + _SCAN_BLOCK_SIZE])
+        starts.append(np.flatnonzero(block == eot_token_id).astype(np.int64) + offset + 1)
+    starts = np.concatenate(starts)
+    # 以 EOT 结尾的数组最后一个"起点"等于数组长度，不是真正的文档
+    return starts[starts < len(dataset)] if len(dataset) else starts
+
+
+class PackedBatch(NamedTuple):
+    """
+    get_packed_batch 的返回值，所有张量形状均为 (batch_size, context_length)。
+
+    segment_ids: 每个位置所属文档在本行中的序号（从 0 开始）
+    position_ids: 每个位置在本行内所属文档片段中的位置，在每个文档（或长文档的段）的起点归零
+    """
+
+    x: torch.Tensor
+    y: torch.Tensor
+    segment_ids: torch.Tensor
+    position_ids: torch.Tensor
+
+
+def packed_row_starts(doc_starts: np.ndarray, num_tokens: int, context_length: int) -> np.ndarray:
+    """
+    get_packed_batch 的候选行首（段起点），只需计算一次。
+
+    每个文档的起点是一个段起点；长于 context_length 的文档按 context_length 切成若干段，每段的起点也是段起点。
+    行首之后至少要有 context_length + 1 个 token，文件末尾放不下一整行的段被丢弃。
+
+    Args:
+        doc_starts: 每个文档的起点，递增，首项为 0
+        num_tokens: token 数组的长度
+        context_length: 每个样本的长度
+
+    Returns:
+        递增的段起点（int64）
+    """
+    doc_starts = np.asarray(doc_starts, dtype=np.int64)
+    lengths = np.diff(np.append(doc_starts, num_tokens))
+    pieces = -(-lengths // context_length)
+    # 第 i 个文档的第 k 段从 doc_starts[i] + k * context_length 开始
+    piece_index = np.arange(int(pieces.sum())) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    starts = np.repeat(doc_starts, pieces) + piece_index * context_length
+    return starts[starts + context_length < num_tokens]
+
+
+def get_packed_batch(
+    dataset: npt.NDArray,
+    doc_starts: np.ndarray,
+    batch_size: int,
+    context_length: int,
+    device: str | torch.device,
+    rng: np.random.Generator | None = None,
+    sampler: BatchSampler | None = None,
+    row_starts: np.ndarray | None = None,
+) -> PackedBatch:
+    """
+    把从文档起点开始的若干个文档打包成 context_length 长的行，并返回文档边界信息，使注意力不跨越 <|endoftext|>。
+
+    每一行从一个段起点（见 packed_row_starts：文档的起点，或长文档中每隔 context_length 的位置）开始，
+    之后依次排着后续的文档，最后一个文档在行尾截断，因此没有任何 padding。
+    行首从段起点中均匀采样：每个段被选为行首的机会均等（但排在短文档之后的 token 还会被前面的行覆盖，
+    所以各 token 被覆盖的次数并不相同）。使用洗牌模式的 BatchSampler.over_indices(len(row_starts)) 时，
+    每个 epoch 恰好以每个段为行首一次，因此每个 token 每个 epoch 至少被覆盖一次。
+
+    segment_ids 和 position_ids 由 doc_starts（document_starts 的结果，只需计算一次）通过二分查找得到；
+    把 segment_ids 传给 segment_attention_mask 即得到块对角的因果注意力掩码，
+    position_ids 可以直接用于位置编码（如 RoPE）。
+
+    Args:
+        dataset: 一维整数 token 数组
+        doc_starts: 每个文档的起点，递增，首项为 0
+        batch_size: batch 大小
+        context_length: 每个样本的长度
+        device: PyTorch 设备字符串
+        rng: 随机数生成器
+        sampler: 采样 row_starts 下标的 BatchSampler（见 BatchSampler.over_indices），给定时忽略 rng
+        row_starts: packed_row_starts 的结果，默认在每次调用时重新计算
+
+    Returns:
+        PackedBatch(x, y, segment_ids, position_ids)
+    """
+    if row_starts is None:
+        row_starts = packed_row_starts(doc_starts, len(dataset), context_length)
+    if len(row_starts) == 0:
+        raise ValueError(f"dataset of length {len(dataset)} is too short for context_length {context_length}")
+    if sampler is not None:
+        if sampler.num_starts != len(row_starts):
+            raise ValueError(
+                f"sampler draws from {sampler.num_starts} starts, but there are {len(row_starts)} packed rows; "
+                "use BatchSampler.over_indices(len(row_starts))"
+            )
+        indices = sampler.next_starts(batch_size)
+    else:
+        indices = (rng if rng is not None else np.random.default_rng()).integers(0, len(row_starts), size=batch_size)
+    starts = row_starts[indices]
+    windows = sliding_window_view(dataset, context_length + 1)
+    x, y = _windows_to_device(windows[starts], device)
+
+    positions = starts[:, None] + np.arange(context_length)
+    docs = np.searchsorted(doc_starts, positions, side="right") - 1
+    segment_ids = docs - docs[:, :1]
+    # 长文档的后续段从行首开始计数，之前的部分对这一行不可见
+    segment_starts = np.maximum(doc_starts[docs], starts[:, None])
+    position_ids = positions - segment_starts
+    return PackedBatch(
+        x,
+        y,
+        torch.from_numpy(segment_ids).to(x.device),
+        torch.from_numpy(position_ids).to(x.device),
+    )
+
+
+def segment_attention_mask(segment_ids: torch.Tensor) -> torch.Tensor:
+    """
+    由 segment_ids (..., seq_len) 构造块对角的因果注意力掩码 (..., seq_len, seq_len)：
+    位置 i 可以看到位置 j 当且仅当 j <= i 且二者属于同一个文档。True 表示可以参与注意力。
+    """
+    seq_len = segment_ids.shape[-1]
+    causal = torch.ones(seq_len, seq_len, dtype=torch.bool, device=segment_ids.device).tril()
+    same_segment = segment_ids[..., :, None] == segment_ids[..., None, :]
+    return same_segment & causal
+
+
+class ShardSpec(NamedTuple):
+    """
+    混合数据集中的一个分片：token 文件路径、采样权重和 token 的 dtype。
+    """
+
+    path: str
+    weight: float
+    dtype: str = "uint16"
+
+
+class MixtureDataset:
+    """
+    由多个 token 分片按权重混合而成的数据集，不需要把分片拼接成一个大文件。
+
+    每一行先按权重选择分片，再在分片内均匀地采样窗口，同一个分片的行用一次 gather 取出。
+    分片在第一次被采到时才以 memmap 打开，同时打开的分片数不超过 max_open_shards（按最近使用淘汰）；
+    分片长度在构造时从文件头或文件大小得到，不需要映射文件。修改权重（set_weights）不需要重新编码。
+    给定 fingerprint 时，构造时就会拒绝不是由该 tokenizer 编码的分片。
+
+    与 BatchSampler 一样，第 step 个 batch 只由 default_rng([seed, step]) 决定，state_dict() 可以存进 checkpoint。
+
+    manifest 是一个 JSON 文件：
+
+        {"shards": [{"path": "web/000.bin", "weight": 0.7, "dtype": "uint16"}, ...]}
+
+    相对路径相对于 manifest 所在目录。
+    """
+
+    def __init__(
+        self,
+        shards: Sequence[ShardSpec],
+        seed: int = 0,
+        max_open_shards: int = 8,
+        fingerprint: bytes | None = None,
+    ):
+        if not shards:
+            raise ValueError("MixtureDataset needs at least one shard")
+        if max_open_shards < 1:
+            raise ValueError(f"max_open_shards must be positive, got {max_open_shards}")
+        self.shards = []
+        for path, weight, dtype in shards:
+            path = os.fspath(path)
+            header = read_shard_header(path)
+            if header is not None:
+                # token_shard 格式的分片以文件头中的 dtype 为准，并在这里一次性检查 tokenizer 是否匹配
+                check_shard(path, header, fingerprint)
+                dtype = header.dtype.name
+            elif fingerprint is not None:
+                raise ValueError(f"{path} has no shard header, so its tokenizer cannot be checked")
+            self.shards.append(ShardSpec(path, float(weight), str(dtype)))
+        self.num_tokens = np.array([num_tokens_in_file(shard.path, shard.dtype) for shard in self.shards])
+        self._dtype = np.result_type(*[np.dtype(shard.dtype) for shard in self.shards])
+        self.seed = seed
+        self.step = 0
+        self.max_open_shards = max_open_shards
+        self._open: OrderedDict[int, np.ndarray] = OrderedDict()
+        self.set_weights([shard.weight for shard in self.shards])
+
+    @classmethod
+    def from_manifest(cls, manifest_path: str | os.PathLike, **kwargs) -> "MixtureDataset":
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        root = os.path.dirname(os.path.abspath(manifest_path))
+        shards = [
+            ShardSpec(os.path.join(root, entry["path"]), entry.get("weight", 1.0), entry.get("dtype", "uint16"))
+            for entry in manifest["shards"]
+        ]
+        return cls(shards, **kwargs)
+
+    def set_weights(self, weights: Sequence[float]) -> None:
+        """
+        设置各分片的采样权重（不需要归一化），权重为 0 的分片不会被采到。
+        """
+        values = np.asarray(weights, dtype=np.float64)
+        if values.shape != (len(self.shards),) or np.any(values < 0) or values.sum() <= 0:
+            raise ValueError(f"expected {len(self.shards)} non-negative weights with a positive sum, got {values}")
+        self.probabilities = values / values.sum()
+
+    def _shard(self, index: int) -> np.ndarray:
+        dataset = self._open.get(index)
+        if dataset is None:
+            if len(self._open) >= self.max_open_shards:
+                # 淘汰最久未使用的分片，释放它的 memmap
+                self._open.popitem(last=False)
+            shard = self.shards[index]
+            dataset = self._open[index] = load_tokens(shard.path, dtype=shard.dtype)
+        self._open.move_to_end(index)
+        return dataset
+
+    def get_batch(
+        self, batch_size: int, context_length: int, device: str | torch.device
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        按当前权重采样一个 batch，返回值与 get_batch 相同。
+        """
+        sampled = self.probabilities > 0
+        too_short = sampled & (self.num_tokens <= context_length)
+        if np.any(too_short):
+            raise ValueError(
+                f"shard {self.shards[int(np.argmax(too_short))].path} is too short for context_length {context_length}"
+            )
+        rng = np.random.default_rng([self.seed, self.step])
+        self.step += 1
+        shard_ids = rng.choice(len(self.shards), size=batch_size, p=self.probabilities)
+        starts = rng.integers(0, self.num_tokens[shard_ids] - context_length)
+
+        windows = np.empty((batch_size, context_length + 1), dtype=self._dtype)
+        for index in np.unique(shard_ids).tolist():
+            rows = np.flatnonzero(shard_ids == index)
+            windows[rows] = sliding_window_view(self._shard(index), context_length + 1)[starts[rows]]
+        return _windows_to_device(windows, device)
+
+    def state_dict(self) -> dict[str, Any]:
+        return {"seed": self.seed, "step": self.step, "probabilities": self.probabilities.tolist()}
+
+    def load_state_dict(self, state_dict: dict[str, Any]) -> None:
+        self.seed = state_dict["seed"]
+        self.step = state_dict["step"]
+        self.set_weights(state_dict["probabilities"])
+
+
+class TokenBudgetSchedule:
+    """
+    按固定的每步 token 数组 batch，并让序列长度从短到长变化（序列长度课程）。
+
+    前 warmup_steps 步中，context_length 从 min_context_length 线性增长到 max_context_length，
+    并向下取整到 multiple_of 的倍数（限制不同形状的个数，便于编译和复用显存）；之后保持 max_context_length。
+    batch_size = tokens_per_batch // context_length，每步的 token 数基本不变，训练前期的短序列步更便宜。
+
+    与 BatchSampler 一起使用时，采样器应按 max_context_length 构造，这样它产出的起点对任何更短的长度都有效；
+    洗牌模式下短序列步把每个 max_context_length 的槽切成首尾相接的短窗口，不会跳过槽内的 token。
+    BatchSampler 按样本数记录进度，batch_size 变化不影响断点续训。
+    """
+
+    def __init__(
+        self,
+        tokens_per_batch: int,
+        max_context_length: int,
+        min_context_length: int | None = None,
+        warmup_steps: int = 0,
+        multiple_of: int = 64,
+    ):
+        min_context_length = min_context_length or max_context_length
+        if not 0 < min_context_length <= max_context_length:
+            raise ValueError(f"need 0 < min_context_length <= max_context_length, got {min_context_length}")
+        if tokens_per_batch < max_context_length:
+            raise ValueError(
+                f"tokens_per_batch {tokens_per_batch} is smaller than max_context_length {max_context_length}"
+            )
+        self.tokens_per_batch = tokens_per_batch
+        self.max_context_length = max_context_length
+        self.min_context_length = min_context_length
+        self.warmup_steps = warmup_steps
+        self.multiple_of = multiple_of
+
+    def context_length(self, step: int) -> int:
+        if step >= self.warmup_steps:
+            return self.max_context_length
+        fraction = step / self.warmup_steps
+        length = self.min_context_length + (self.max_context_length - self.min_context_length) * fraction
+        length = int(length) // self.multiple_of * self.multiple_of
+        return min(max(length, self.min_context_length), self.max_context_length)
+
+    def batch_size(self, step: int) -> int:
+        return self.tokens_per_batch // self.context_length(step)
+
+    def __call__(self, step: int) -> tuple[int, int]:
+        """
+        返回第 step 步的 (batch_size, context_length)。
+        """
+        return self.batch_size(step), self.context_length(step)
+
+
+def get_budget_batch(
+    dataset: npt.NDArray,
+    schedule: TokenBudgetSchedule,
+    step: int,
+    device: str | torch.device,
+    rng: np.random.Generator | None = None,
+    sampler: BatchSampler | None = None,
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    按 schedule 在第 step 步的 (batch_size, context_length) 采样一个 batch，其余与 get_batch 相同。
+    """
+    batch_size, context_length = schedule(step)
+    return get_batch(dataset, batch_size, context_length, device, rng, sampler)
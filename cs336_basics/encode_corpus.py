@@ -0,0 +1,128 @@
+import os
+import tempfile
+
+import numpy as np
+
+from cs336_basics.chunking import DEFAULT_TASKS_PER_PROCESS, map_chunks, plan_chunks
+from cs336_basics.token_shard import open_shard, shard_file_size, shard_header, write_shard_header
+from cs336_basics.tokenizer import Tokenizer, token_dtype
+
+# 每个任务处理的目标字节数，决定了单个 worker 的峰值内存
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+# 每个 worker 进程持有一份 tokenizer，只在进程启动时传递一次
+_worker_tokenizer: Tokenizer | None = None
+
+
+def _init_worker(tokenizer: Tokenizer) -> None:
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _encode_chunk(task: tuple[str, int, int, str, np.dtype, int]) -> tuple[int, np.ndarray]:
+    """
+    编码文件中的 [start, end) 字节区间，结果写入临时文件 part_path，返回 (token 数, 块内 EOT token 的位置)。
+    """
+    input_path, start, end, part_path, dtype, eot_token_id = task
+    with open(input_path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+    assert _worker_tokenizer is not None, "worker process was not initialized"
+    ids = _worker_tokenizer.encode_to_array(text, dtype=dtype)
+    ids.tofile(part_path)
+    return len(ids), np.flatnonzero(ids == eot_token_id)
+
+
+def encode_file(
+    tokenizer: Tokenizer,
+    input_path: str | os.PathLike,
+    output_path: str | os.PathLike,
+    num_processes: int | None = None,
+    split_special_token: str = "<|endoftext|>",
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    tasks_per_process: int = DEFAULT_TASKS_PER_PROCESS,
+) -> np.ndarray:
+    """
+    并行地将整个语料文件编码为扁平的 token ID 数组，写入 output_path（token_shard 格式）。
+
+    文件先在 split_special_token 处过度切分为许多小块（至少 num_processes * tasks_per_process 块，
+    每块不超过约 chunk_size 字节），空闲的 worker 进程依次领取并独立编码，每块的结果写入输出目录下的临时文件；
+    全部完成后按原顺序把临时文件逐个追加到输出文件（每次只有一块驻留内存），再写入文档起点索引。
+    特殊 token 会切断预分词，因此只要切分点不落在某个（更长的、与之重叠的）特殊 token 内部，
+    就不会改变编码结果；边界的选择见 chunking.find_chunk_boundaries。
+
+    输出文件的头部记录了 dtype、词表大小和 tokenizer 指纹，token 之后是以 split_special_token
+    为文档结尾的文档起点索引（由各块的编码结果顺带得到，不需要再扫描一遍），
+    读取端（data.load_tokens / token_shard.open_shard）打开时不需要扫描数据。
+
+    Args:
+        tokenizer: 用于编码的 tokenizer，split_special_token 必须是它的特殊 token
+        input_path: 输入语料（UTF-8 文本）
+        output_path: 输出的 token 文件
+        num_processes: worker 进程数，默认为 CPU 核数
+        split_special_token: 用于切分文件的特殊 token
+        chunk_size: 每个任务的最大目标字节数
+        tasks_per_process: 每个进程平均分到的任务数
+
+    Returns:
+        以只读 memmap 方式打开的输出 token 数组（uint16 或 uint32）
+    """
+    if split_special_token not in tokenizer.special_token_ids:
+        raise ValueError(
+            f"split_special_token {split_special_token!r} must be a special token of the tokenizer, "
+            "otherwise chunk boundaries could change the pre-tokenization"
+        )
+    num_processes = num_processes or os.cpu_count() or 1
+    eot_token_id = tokenizer.special_token_ids[split_special_token]
+    dtype = token_dtype(tokenizer.vocab.num_ids)
+    input_path = os.fspath(input_path)
+    output_path = os.fspath(output_path)
+
+    chunks = plan_chunks(
+        input_path,
+        num_processes,
+        split_special_token.encode("utf-8"),
+        tasks_per_process,
+        max_chunk_size=chunk_size,
+        special_tokens=[token.encode("utf-8") for token in tokenizer.special_tokens],
+    )
+
+    # 临时文件放在输出文件所在目录，保证和输出在同一个文件系统上
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as tmp_dir:
+        tasks = [
+            (input_path, start, end, os.path.join(tmp_dir, f"part{i:06d}.bin"), dtype, eot_token_id)
+            for i, (start, end) in enumerate(chunks)
+        ]
+        # 在主进程中完成一次 tiktoken 检查（访问 backend 时进行），worker 反序列化后只需重建 Encoding
+        _ = tokenizer.backend
+        results = list(map_chunks(_encode_chunk, tasks, num_processes, _init_worker, (tokenizer,)))
+        counts = [count for count, _ in results]
+        chunk_offsets = np.cumsum([0] + counts)
+        total = int(chunk_offsets[-1])
+
+        # 文档从 0 和每个 EOT 之后开始，与 data.document_starts 的结果一致
+        doc_starts = np.concatenate(
+            [np.zeros(1, dtype=np.int64)]
+            + [positions.astype(np.int64) + offset + 1 for (_, positions), offset in zip(results, chunk_offsets)]
+        )
+        if total:
+            doc_starts = doc_starts[doc_starts < total]
+
+        # 按原顺序把每块结果追加到输出文件，每次只有一块驻留内存
+        header = shard_header(
+            dtype, tokenizer.vocab.num_ids, total, len(doc_starts), eot_token_id, tokenizer.fingerprint()
+        )
+        with open(output_path, "wb") as f:
+            write_shard_header(f, header)
+            f.seek(header.tokens_offset)
+            for task in tasks:
+                part_path = task[3]
+                f.write(np.fromfile(part_path, dtype=dtype).astype(dtype.newbyteorder("<"), copy=False).tobytes())
+                os.remove(part_path)
+            f.seek(header.index_offset)
+            f.write(doc_starts.astype("<i8").tobytes())
+            f.truncate(shard_file_size(header))
+
+    tokens, _, _ = open_shard(output_path)
+    return tokens
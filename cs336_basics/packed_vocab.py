@@ -0,0 +1,171 @@
+import zlib
+from collections.abc import Iterator, Mapping, Sequence
+
+import numpy as np
+
+# 解码时每次最多展开多少个 token，限制临时下标数组的大小
+_DECODE_BLOCK = 1 << 16
+
+
+class PackedVocab(Mapping):
+    """
+    紧凑的词表存储，对外表现为只读的 dict[int, bytes]。
+
+    所有 token 的字节拼接在一个连续的 uint8 缓冲区 blob 中，token i 的字节为
+    blob[offsets[i]:offsets[i + 1]]，词表中缺失的 ID 长度为 0。
+    bytes → ID 的反查使用一个开放寻址哈希表 index（crc32 + 线性探测，空槽为 -1）。
+    三者都是普通的 NumPy 数组，可以直接来自 mmap，多进程之间共享时不会被写入。
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, index: np.ndarray | None = None):
+        self.blob = blob
+        self.offsets = offsets
+        self.num_ids = len(offsets) - 1
+        self.index = index if index is not None else self._build_index()
+        self._len = int(np.count_nonzero(offsets[1:] != offsets[:-1]))
+
+    @classmethod
+    def from_dict(cls, vocab: Mapping[int, bytes]) -> "PackedVocab":
+        num_ids = max(vocab, default=-1) + 1
+        token_bytes = [vocab.get(i, b"") for i in range(num_ids)]
+        offsets = np.zeros(num_ids + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in token_bytes], out=offsets[1:])
+        blob = np.frombuffer(b"".join(token_bytes), dtype=np.uint8)
+        return cls(blob, offsets)
+
+    def _build_index(self) -> np.ndarray:
+        blob = self.blob.tobytes()
+        offsets = self.offsets.tolist()
+        size = 1
+        while size < 2 * max(self.num_ids, 1):
+            size *= 2
+        mask = size - 1
+        index = np.full(size, -1, dtype=np.int32)
+        for token_id in range(self.num_ids):
+            token_bytes = blob[offsets[token_id] : offsets[token_id + 1]]
+            if not token_bytes:
+                continue
+            slot = zlib.crc32(token_bytes) & mask
+            while index[slot] >= 0:
+                other = int(index[slot])
+                # 重复的 bytes 以后出现的 ID 为准（和 {v: k for k, v in vocab.items()} 一致）
+                if blob[offsets[other] : offsets[other + 1]] == token_bytes:
+                    break
+                slot = (slot + 1) & mask
+            index[slot] = token_id
+        return index
+
+    def token_id(self, token_bytes: bytes) -> int | None:
+        """
+        查找 token_bytes 对应的 ID，不存在时返回 None。
+        """
+        index = self.index
+        mask = len(index) - 1
+        slot = zlib.crc32(token_bytes) & mask
+        while True:
+            token_id = int(index[slot])
+            if token_id < 0:
+                return None
+            if self.blob[self.offsets[token_id] : self.offsets[token_id + 1]].tobytes() == token_bytes:
+                return token_id
+            slot = (slot + 1) & mask
+
+    def join(self, ids: np.ndarray) -> bytes:
+        """
+        把一组 token ID 的字节按顺序拼接起来，词表之外的 ID 被跳过。
+        """
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        ids = ids[(ids >= 0) & (ids < self.num_ids)]
+        pieces = []
+        for i in range(0, len(ids), _DECODE_BLOCK):
+            block = ids[i : i + _DECODE_BLOCK]
+            starts = self.offsets[block]
+            lengths = self.offsets[block + 1] - starts
+            total = int(lengths.sum())
+            if total == 0:
+                continue
+            # 把每个 token 在 blob 中的起点展开成逐字节的下标，一次 gather 完成拼接
+            shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+            pieces.append(self.blob[np.arange(total) + shifts].tobytes())
+        return b"".join(pieces)
+
+    def inverse(self) -> "PackedVocabInverse":
+        """
+        返回 bytes → ID 的只读映射视图。
+        """
+        return PackedVocabInverse(self)
+
+    def __getitem__(self, token_id: int) -> bytes:
+        if not 0 <= token_id < self.num_ids:
+            raise KeyError(token_id)
+        start, end = self.offsets[token_id], self.offsets[token_id + 1]
+        if start == end:
+            raise KeyError(token_id)
+        return self.blob[start:end].tobytes()
+
+    def __iter__(self) -> Iterator[int]:
+        present = np.flatnonzero(self.offsets[1:] != self.offsets[:-1])
+        return iter(present.tolist())
+
+    def __len__(self) -> int:
+        return self._len
+
+
+class PackedVocabInverse(Mapping):
+    """
+    PackedVocab 的 bytes → ID 反查视图，对外表现为只读的 dict[bytes, int]。
+    """
+
+    def __init__(self, vocab: PackedVocab):
+        self._vocab = vocab
+
+    def __getitem__(self, token_bytes: bytes) -> int:
+        token_id = self._vocab.token_id(token_bytes)
+        if token_id is None:
+            raise KeyError(token_bytes)
+        return token_id
+
+    def __contains__(self, token_bytes: object) -> bool:
+        return isinstance(token_bytes, bytes) and self._vocab.token_id(token_bytes) is not None
+
+    def __iter__(self) -> Iterator[bytes]:
+        # 重复的 bytes 只出现一次
+        return iter({self._vocab[token_id]: None for token_id in self._vocab})
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self._vocab.index >= 0))
+
+
+class PackedMerges(Sequence):
+    """
+    紧凑的 merges 存储，对外表现为只读的 list[tuple[bytes, bytes]]。
+
+    pairs[rank] = (左 token ID, 右 token ID, 合并结果 token ID)，按优先级排列。
+    """
+
+    def __init__(self, pairs: np.ndarray, vocab: PackedVocab):
+        self.pairs = pairs
+        self._vocab = vocab
+
+    @classmethod
+    def from_pairs(
+        cls, merges: Sequence[tuple[bytes, bytes]], token_to_id: Mapping[bytes, int], vocab: PackedVocab
+    ) -> "PackedMerges":
+        pairs = np.array(
+            [(token_to_id[a], token_to_id[b], token_to_id[a + b]) for a, b in merges], dtype=np.int32
+        ).reshape(-1, 3)
+        return cls(pairs, vocab)
+
+    def __getitem__(self, rank):
+        if isinstance(rank, slice):
+            return [self[i] for i in range(*rank.indices(len(self)))]
+        left, right, _ = self.pairs[rank]
+        return self._vocab[int(left)], self._vocab[int(right)]
+
+    def __len__(self) -> int:
+        return len(self.pairs)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return len(self) == len(other) and all(a == tuple(b) for a, b in zip(self, other))
@@ -0,0 +1,208 @@
+import io
+import itertools
+import multiprocessing as mp
+import os
+import traceback
+from collections.abc import Iterator, Sequence
+
+import numpy as np
+import torch
+from numpy.lib.stride_tricks import sliding_window_view
+
+from cs336_basics.chunking import plan_chunks
+from cs336_basics.data import _windows_to_device
+from cs336_basics.tokenizer import Tokenizer, token_dtype
+
+# 每个任务（文本块）的最大字节数，小块有利于 worker 之间的负载均衡
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+# worker 每次发回的窗口数上限
+_WINDOWS_PER_MESSAGE = 1024
+
+
+def _chunk_windows(
+    tokenizer: Tokenizer, task: tuple[str, int, int], context_length: int, dtype: np.dtype
+) -> Iterator[np.ndarray]:
+    """
+    用 encode_iterable 流式地编码文件中的 [start, end) 字节区间，切成互不重叠的训练窗口：
+    第 k 个窗口为 tokens[k * context_length : (k + 1) * context_length + 1]（相邻窗口共用一个 token，
+    每个 token 都恰好作为一次标签）。每次产出至多 _WINDOWS_PER_MESSAGE 个窗口，块末尾不足一个窗口的 token 被丢弃。
+    """
+    path, start, end = task
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+    block_tokens = _WINDOWS_PER_MESSAGE * context_length + 1
+    pending: list[int] = []
+    for ids in _batched(tokenizer.encode_iterable(io.StringIO(text)), block_tokens):
+        pending.extend(ids)
+        if len(pending) >= block_tokens:
+            tokens = np.array(pending, dtype=dtype)
+            windows = sliding_window_view(tokens, context_length + 1)[::context_length]
+            yield windows.copy()
+            # 最后一个窗口的末尾 token 是下一个窗口的开头
+            pending = pending[len(windows) * context_length :]
+    if len(pending) > context_length:
+        tokens = np.array(pending, dtype=dtype)
+        yield sliding_window_view(tokens, context_length + 1)[::context_length].copy()
+
+
+def _batched(iterable, n: int) -> Iterator[list[int]]:
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, n)):
+        yield batch
+
+
+def _tokenize_worker(
+    tokenizer: Tokenizer, tasks: mp.Queue, results: mp.Queue, context_length: int, dtype: np.dtype
+) -> None:
+    """
+    worker 进程：依次领取任务，把窗口放进有界的结果队列（队列满时阻塞，形成背压），收到 None 时退出。
+    """
+    try:
+        while (task := tasks.get()) is not None:
+            for windows in _chunk_windows(tokenizer, task, context_length, dtype):
+                results.put(("windows", windows))
+        results.put(("done", None))
+    except BaseException:
+        results.put(("error", traceback.format_exc()))
+
+
+class TextBatchLoader:
+    """
+    直接从原始文本语料产出训练 batch，不需要事先编码整个语料。
+
+    文件在 split_special_token 处切成许多小块（见 chunking.plan_chunks），num_workers 个 worker 进程
+    依次领取文本块，用 Tokenizer.encode_iterable 流式编码并切成长度为 context_length + 1 的窗口，
+    经有界队列发回主进程。主进程维护一个容量为 shuffle_buffer_size 个窗口的洗牌缓冲区：缓冲区满后，
+    每次随机取出 batch_size 个窗口组成一个 batch，再用新到的窗口补满。产出的 (x, y) 与 get_batch 形状相同。
+
+    每个 epoch 按 seed 决定的随机顺序遍历所有文本块；num_epochs 为 None 时无限循环。
+    num_workers 为 0 时在当前进程中编码，便于调试。
+
+    用法：
+
+        loader = TextBatchLoader(tokenizer, "corpus.txt", batch_size=32, context_length=256)
+        for step, (x, y) in zip(range(num_steps), loader):
+            ...
+    """
+
+    def __init__(
+        self,
+        tokenizer: Tokenizer,
+        paths: str | os.PathLike | Sequence[str | os.PathLike],
+        batch_size: int,
+        context_length: int,
+        device: str | torch.device = "cpu",
+        num_workers: int | None = None,
+        shuffle_buffer_size: int | None = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        split_special_token: str = "<|endoftext|>",
+        seed: int = 0,
+        num_epochs: int | None = None,
+    ):
+        if split_special_token not in tokenizer.special_token_ids:
+            raise ValueError(
+                f"split_special_token {split_special_token!r} must be a special token of the tokenizer, "
+                "otherwise chunk boundaries could change the pre-tokenization"
+            )
+        if isinstance(paths, (str, os.PathLike)):
+            paths = [paths]
+        self.tokenizer = tokenizer
+        self.batch_size = batch_size
+        self.context_length = context_length
+        self.device = device
+        self.num_workers = (os.cpu_count() or 1) if num_workers is None else num_workers
+        self.shuffle_buffer_size = shuffle_buffer_size or 16 * batch_size
+        if self.shuffle_buffer_size < batch_size:
+            raise ValueError(f"shuffle_buffer_size {self.shuffle_buffer_size} is smaller than batch_size {batch_size}")
+        self.seed = seed
+        self.num_epochs = num_epochs
+        self.dtype = token_dtype(tokenizer.vocab.num_ids)
+
+        delimiter = split_special_token.encode("utf-8")
+        special_tokens = [token.encode("utf-8") for token in tokenizer.special_tokens]
+        self.tasks = [
+            (os.fspath(path), start, end)
+            for path in paths
+            for start, end in plan_chunks(
+                path, max(self.num_workers, 1), delimiter, max_chunk_size=chunk_size, special_tokens=special_tokens
+            )
+        ]
+        if not self.tasks:
+            raise ValueError("the corpus is empty")
+
+    def __iter__(self) -> Iterator[tuple[torch.Tensor, torch.Tensor]]:
+        rng = np.random.default_rng(self.seed)
+        capacity, batch_size = self.shuffle_buffer_size, self.batch_size
+        buffer = np.empty((capacity, self.context_length + 1), dtype=self.dtype)
+        filled = 0
+        for windows in self._windows(rng):
+            pos = 0
+            while pos < len(windows):
+                take = min(capacity - filled, len(windows) - pos)
+                buffer[filled : filled + take] = windows[pos : pos + take]
+                filled += take
+                pos += take
+                if filled < capacity:
+                    continue
+                picked = rng.choice(capacity, size=batch_size, replace=False)
+                yield _windows_to_device(buffer[picked], self.device)
+                # 用缓冲区末尾未被取走的窗口填补空位，缓冲区前 capacity - batch_size 个位置保持有效
+                last = capacity - batch_size
+                holes = picked[picked < last]
+                buffer[holes] = buffer[np.setdiff1d(np.arange(last, capacity), picked)]
+                filled = last
+
+        # 数据耗尽（有限个 epoch）时把缓冲区中剩余的窗口打乱后输出，不足一个 batch 的部分丢弃
+        remaining = buffer[rng.permutation(filled)]
+        for start in range(0, filled - batch_size + 1, batch_size):
+            yield _windows_to_device(remaining[start : start + batch_size], self.device)
+
+    def _windows(self, rng: np.random.Generator) -> Iterator[np.ndarray]:
+        epochs = itertools.count() if self.num_epochs is None else range(self.num_epochs)
+        for _ in epochs:
+            tasks = [self.tasks[i] for i in rng.permutation(len(self.tasks))]
+            if self.num_workers == 0:
+                for task in tasks:
+                    yield from _chunk_windows(self.tokenizer, task, self.context_length, self.dtype)
+            else:
+                yield from self._run_workers(tasks)
+
+    def _run_workers(self, tasks: list[tuple[str, int, int]]) -> Iterator[np.ndarray]:
+        """
+        启动 worker 进程处理一个 epoch 的任务，按到达顺序产出窗口。
+        """
+        # 在主进程中完成一次 tiktoken 检查（访问 backend 时进行），worker 反序列化后只需重建 Encoding
+        _ = self.tokenizer.backend
+        task_queue: mp.Queue = mp.Queue()
+        result_queue: mp.Queue = mp.Queue(maxsize=4 * self.num_workers)
+        for task in tasks:
+            task_queue.put(task)
+        for _ in range(self.num_workers):
+            task_queue.put(None)
+        workers = [
+            mp.Process(
+                target=_tokenize_worker,
+                args=(self.tokenizer, task_queue, result_queue, self.context_length, self.dtype),
+                daemon=True,
+            )
+            for _ in range(self.num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            running = len(workers)
+            while running:
+                kind, payload = result_queue.get()
+                if kind == "windows":
+                    yield payload
+                elif kind == "done":
+                    running -= 1
+                else:
+                    raise RuntimeError(f"tokenizer worker failed:\n{payload}")
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
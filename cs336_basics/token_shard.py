@@ -0,0 +1,158 @@
+import os
+import struct
+from typing import NamedTuple
+
+import numpy as np
+
+# 自描述的 token 分片文件，布局（小端序）：
+# 头部 | token 数据（dtype[num_tokens]，从 tokens_offset 开始）| 文档起点索引（int64[num_docs]，从 index_offset 开始）
+# 头部：(魔数, dtype 名, 词表 ID 数, token 数, 文档数, EOT token ID（没有则为 -1）, tokenizer 指纹,
+#        tokens_offset, index_offset)
+SHARD_FILE_MAGIC = b"BPESHD\x00\x01"
+_SHARD_FILE_HEADER = struct.Struct("<8s8sQQQq16sQQ")
+
+# tokenizer 指纹的字节数，未知时为全 0
+FINGERPRINT_SIZE = 16
+
+# token 数据的起点按 64 字节对齐
+_TOKENS_OFFSET = 64 * (-(-_SHARD_FILE_HEADER.size // 64))
+
+
+class ShardHeader(NamedTuple):
+    dtype: np.dtype
+    vocab_size: int
+    num_tokens: int
+    num_docs: int
+    eot_token_id: int
+    fingerprint: bytes
+    tokens_offset: int
+    index_offset: int
+
+
+def shard_header(
+    dtype: np.dtype, vocab_size: int, num_tokens: int, num_docs: int, eot_token_id: int, fingerprint: bytes
+) -> ShardHeader:
+    """
+    根据内容大小计算各部分的偏移，构造分片头部。
+    """
+    if len(fingerprint) > FINGERPRINT_SIZE:
+        raise ValueError(f"fingerprint must be at most {FINGERPRINT_SIZE} bytes")
+    dtype = np.dtype(dtype)
+    fingerprint = fingerprint.ljust(FINGERPRINT_SIZE, b"\x00")
+    index_offset = 8 * (-(-(_TOKENS_OFFSET + num_tokens * dtype.itemsize) // 8))
+    return ShardHeader(
+        dtype, vocab_size, num_tokens, num_docs, eot_token_id, fingerprint, _TOKENS_OFFSET, index_offset
+    )
+
+
+def shard_file_size(header: ShardHeader) -> int:
+    return header.index_offset + 8 * header.num_docs
+
+
+def write_shard_header(f, header: ShardHeader) -> None:
+    f.write(
+        _SHARD_FILE_HEADER.pack(
+            SHARD_FILE_MAGIC,
+            header.dtype.name.encode("ascii"),
+            header.vocab_size,
+            header.num_tokens,
+            header.num_docs,
+            header.eot_token_id,
+            header.fingerprint,
+            header.tokens_offset,
+            header.index_offset,
+        )
+    )
+
+
+def write_shard(
+    path: str | os.PathLike,
+    tokens: np.ndarray,
+    doc_starts: np.ndarray,
+    vocab_size: int,
+    eot_token_id: int = -1,
+    fingerprint: bytes = b"",
+) -> None:
+    """
+    把内存中的 token 数组和文档起点写成一个分片文件（大语料由 encode_file 分块写入）。
+    """
+    header = shard_header(tokens.dtype, vocab_size, len(tokens), len(doc_starts), eot_token_id, fingerprint)
+    with open(path, "wb") as f:
+        write_shard_header(f, header)
+        f.seek(header.tokens_offset)
+        f.write(np.ascontiguousarray(tokens, dtype=tokens.dtype.newbyteorder("<")).tobytes())
+        f.seek(header.index_offset)
+        f.write(np.asarray(doc_starts, dtype="<i8").tobytes())
+        f.truncate(shard_file_size(header))
+
+
+def read_shard_header(path: str | os.PathLike) -> ShardHeader | None:
+    """
+    读取分片头部，文件不是分片格式时返回 None。只读取固定大小的头部，开销与文件大小无关。
+    """
+    with open(path, "rb") as f:
+        buf = f.read(_SHARD_FILE_HEADER.size)
+    if len(buf) < _SHARD_FILE_HEADER.size or not buf.startswith(SHARD_FILE_MAGIC):
+        return None
+    _, dtype, vocab_size, num_tokens, num_docs, eot_token_id, fingerprint, tokens_offset, index_offset = (
+        _SHARD_FILE_HEADER.unpack(buf)
+    )
+    return ShardHeader(
+        np.dtype(dtype.rstrip(b"\x00").decode("ascii")),
+        vocab_size,
+        num_tokens,
+        num_docs,
+        eot_token_id,
+        fingerprint,
+        tokens_offset,
+        index_offset,
+    )
+
+
+def check_shard(
+    path: str | os.PathLike,
+    header: ShardHeader,
+    fingerprint: bytes | None = None,
+    vocab_size: int | None = None,
+) -> None:
+    """
+    检查分片是否由期望的 tokenizer 生成，不一致时抛出 ValueError。
+    """
+    if fingerprint is not None and header.fingerprint != fingerprint.ljust(FINGERPRINT_SIZE, b"\x00"):
+        raise ValueError(
+            f"{path} was encoded with a different tokenizer "
+            f"(fingerprint {header.fingerprint.hex()}, expected {fingerprint.hex()})"
+        )
+    if vocab_size is not None and header.vocab_size != vocab_size:
+        raise ValueError(f"{path} was encoded with a vocabulary of {header.vocab_size} ids, expected {vocab_size}")
+    if os.path.getsize(path) < shard_file_size(header):
+        raise ValueError(f"{path} is truncated")
+
+
+def open_shard(
+    path: str | os.PathLike,
+    fingerprint: bytes | None = None,
+    vocab_size: int | None = None,
+) -> tuple[np.ndarray, np.ndarray, ShardHeader]:
+    """
+    以只读 memmap 打开分片，返回 (tokens, doc_starts, header)。不扫描 token 数据，开销与文件大小无关。
+
+    Args:
+        path: 分片文件路径
+        fingerprint: 期望的 tokenizer 指纹（Tokenizer.fingerprint()），不一致时抛出 ValueError
+        vocab_size: 期望的词表 ID 数，不一致时抛出 ValueError
+    """
+    header = read_shard_header(path)
+    if header is None:
+        raise ValueError(f"{path} is not a token shard file")
+    check_shard(path, header, fingerprint, vocab_size)
+    tokens = _memmap(path, header.dtype.newbyteorder("<"), header.tokens_offset, header.num_tokens)
+    doc_starts = _memmap(path, np.dtype("<i8"), header.index_offset, header.num_docs)
+    return tokens, doc_starts, header
+
+
+def _memmap(path: str | os.PathLike, dtype: np.dtype, offset: int, count: int) -> np.ndarray:
+    # np.memmap 不支持长度为 0 的映射
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
@@ -1,89 +1,768 @@
+import codecs
+import hashlib
+import itertools
+import json
+import mmap
+import os
+import struct
+import time
+from collections import Counter
+from functools import lru_cache
+
+import numpy as np
+import numpy.typing as npt
 import regex as re
-from typing import List, Optional, Iterable, Iterator, Dict, Tuple
+import tiktoken
+from typing import List, Mapping, Optional, Iterable, Iterator, Dict, Sequence, Tuple
+
+from cs336_basics.packed_vocab import PackedMerges, PackedVocab
 
 # GPT-2 的预分词正则表达式
 GPT2_SPLIT_PATTERN = r"""'(?:[sdmt]|ll|ve|re)| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+GPT2_SPLIT_RE = re.compile(GPT2_SPLIT_PATTERN)
+
+# 反向查找最后一个“非空白字符 + 空白字符”的位置，GPT-2 预分词一定在两者之间切开
+_LAST_BOUNDARY_RE = re.compile(r"(?r)\S\s")
+
+# tiktoken 的正则在约 100 万个字符的连续空白（任意空白字符的组合）上会栈溢出，以 Rust panic 的形式失败
+# 并在 stderr 打印回溯；含有这么长（留足余量）的连续空白的文本改用纯 Python 编码
+_TIKTOKEN_MAX_WHITESPACE_RUN = 1 << 16
+_WHITESPACE_HALF_RUN_RE = re.compile(rf"\s{{{_TIKTOKEN_MAX_WHITESPACE_RUN // 2}}}")
+
+# 预分词缓存的最大条目数，超过后整体清空，避免长时间运行时内存无限增长
+PRETOKEN_CACHE_SIZE = 1 << 16
+
+# encode_to_array 每次处理的字符数，限制中间 Python 列表的大小
+_ARRAY_BLOCK_SIZE = 1 << 16
+
+# 二进制 tokenizer 文件：魔数 + 头部
+# (ID 数, 哈希索引槽数, merge 数, 特殊 token 数, token 字节总长, 特殊 token 字节总长)
+TOKENIZER_FILE_MAGIC = b"BPETOK\x00\x02"
+_TOKENIZER_FILE_HEADER = struct.Struct("<8sQQQQQQ")
+
+
+def token_dtype(vocab_size: int) -> np.dtype:
+    """
+    选择能容纳所有 token ID 的最小无符号整数类型。
+    """
+    return np.dtype(np.uint16) if vocab_size <= 2**16 else np.dtype(np.uint32)
+
+
+def _has_long_whitespace_run(text: str) -> bool:
+    """
+    判断 text 中是否可能有不短于 _TIKTOKEN_MAX_WHITESPACE_RUN 的连续空白。
+
+    每隔 half = _TIKTOKEN_MAX_WHITESPACE_RUN // 2 个字符取一个采样点：这样的连续空白必然覆盖某个采样点 p，
+    且从 p 开始至少还有 half 个空白字符，因此只需在是空白的采样点上匹配 half 个空白，不必扫描整个文本。
+    长度在 [half, 2 * half) 之间的连续空白也可能被判为过长，这只会让这段文本改用较慢的纯 Python 编码。
+    """
+    half = _TIKTOKEN_MAX_WHITESPACE_RUN // 2
+    for p in range(0, len(text) - half + 1, half):
+        if text[p].isspace() and _WHITESPACE_HALF_RUN_RE.match(text, p):
+            return True
+    return False
+
+
+@lru_cache
+def gpt2_bytes_to_unicode() -> Dict[int, str]:
+    """
+    GPT-2 的 vocab.json / merges.txt 中把每个字节映射成一个可打印的 unicode 字符，
+    可打印字符保持不变，其余字节依次映射到 chr(256 + n)。
+    """
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2**8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2**8 + n)
+            n += 1
+    return dict(zip(bs, (chr(c) for c in cs)))
+
+
+class _SpecialTokenMatcher:
+    """
+    特殊 token 匹配器，构造时把所有特殊 token 建成一棵 trie，并编译成等价的正则。
+
+    trie 中同一节点的各个分支首字符互不相同，因此匹配时不会在兄弟分支之间回溯；
+    终止节点之后的部分用贪婪的可选分组表示，保证在同一起点取最长的特殊 token，
+    例如 "<|endoftext|><|endoftext|>" 优先于 "<|endoftext|>"。
+    """
+
+    def __init__(self, tokens: List[str]):
+        self.trie: Dict[str, dict] = {}
+        for token in tokens:
+            node = self.trie
+            for ch in token:
+                node = node.setdefault(ch, {})
+            node[""] = {}  # 终止标记
+        self.max_len = max((len(token) for token in tokens), default=0)
+        self.pattern = re.compile(self._to_pattern(self.trie)) if tokens else None
+
+    @classmethod
+    def _to_pattern(cls, node: Dict[str, dict]) -> str:
+        branches = [re.escape(ch) + cls._to_pattern(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # 当前节点本身就是一个完整的特殊 token 时，后续部分可选（贪婪，优先更长的匹配）
+        return f"(?:{body})?" if "" in node else body
+
+    def finditer(self, text: str, pos: int = 0) -> Iterator[re.Match]:
+        """
+        从 pos 开始从左到右查找所有不重叠的特殊 token（同一位置取最长）。
+        """
+        if self.pattern is None:
+            return iter(())
+        return self.pattern.finditer(text, pos)
+
+    def is_partial(self, text: str, start: int) -> bool:
+        """
+        判断 text[start:] 是否是某个特殊 token 的真前缀，即之后的输入可能把它补全或延长。
+        """
+        node = self.trie
+        for i in range(start, len(text)):
+            node = node.get(text[i])
+            if node is None:
+                return False
+        return any(node)
+
+
+class TokenizerStats:
+    """
+    Tokenizer.encode 的分阶段统计（通过 Tokenizer.enable_profiling 开启）。
+
+    各阶段耗时（秒）：
+        special_split_time: 按特殊 token 切分
+        pretokenize_time: GPT-2 正则预分词
+        merge_time: 缓存未命中时的 BPE 合并（_encode_bytes）
+        build_time: 查缓存和拼接结果列表
+        tiktoken_time: tiktoken 引擎编码普通文本（包含预分词和合并）
+
+    使用 tiktoken 引擎时预分词和合并都在 tiktoken 内部完成，pretoken 和缓存相关的计数保持为 0。
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        清零所有统计。
+        """
+        self.calls = 0
+        self.bytes_in = 0
+        self.tokens_out = 0
+        self.special_tokens = 0
+        self.pretokens = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.longest_pretoken = 0
+        # pretoken 长度（字符数）→ 出现次数
+        self.pretoken_lengths: Counter = Counter()
+        self.total_time = 0.0
+        self.special_split_time = 0.0
+        self.pretokenize_time = 0.0
+        self.merge_time = 0.0
+        self.build_time = 0.0
+        self.tiktoken_time = 0.0
+
+    @property
+    def cache_hit_rate(self) -> float:
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups else 0.0
+
+    def length_histogram(self) -> Dict[int, int]:
+        """
+        按 2 的幂分桶的 pretoken 长度直方图：桶 k 统计长度在 (k/2, k] 之间的 pretoken 数。
+        """
+        histogram: Dict[int, int] = {}
+        for length, count in sorted(self.pretoken_lengths.items()):
+            bucket = 1 << max(length - 1, 0).bit_length()
+            histogram[bucket] = histogram.get(bucket, 0) + count
+        return histogram
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            "calls": self.calls,
+            "bytes_in": self.bytes_in,
+            "tokens_out": self.tokens_out,
+            "special_tokens": self.special_tokens,
+            "pretokens": self.pretokens,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_hit_rate": self.cache_hit_rate,
+            "longest_pretoken": self.longest_pretoken,
+            "length_histogram": self.length_histogram(),
+            "total_time": self.total_time,
+            "special_split_time": self.special_split_time,
+            "pretokenize_time": self.pretokenize_time,
+            "merge_time": self.merge_time,
+            "build_time": self.build_time,
+            "tiktoken_time": self.tiktoken_time,
+        }
+
+    def report(self) -> str:
+        """
+        返回可读的吞吐量和各阶段耗时报告。
+        """
+        total = self.total_time or float("inf")
+        lines = [
+            f"calls: {self.calls}, bytes in: {self.bytes_in}, tokens out: {self.tokens_out}",
+            f"throughput: {self.bytes_in / total / 1e6:.2f} MB/s, {self.tokens_out / total:.0f} tokens/s",
+            f"pretokens: {self.pretokens} (longest {self.longest_pretoken} chars), "
+            f"cache hit rate: {self.cache_hit_rate:.1%}",
+        ]
+        for name in ("special_split", "pretokenize", "merge", "build", "tiktoken"):
+            seconds = getattr(self, f"{name}_time")
+            lines.append(f"  {name:<14}{seconds:10.4f}s {seconds / total:7.1%}")
+        histogram = ", ".join(f"<={k}: {v}" for k, v in self.length_histogram().items())
+        lines.append(f"pretoken length histogram: {histogram}")
+        return "\n".join(lines)
 
 
 class Tokenizer:
     def __init__(
         self,
-        vocab: Dict[int, bytes],
-        merges: List[Tuple[bytes, bytes]],
+        vocab: Mapping[int, bytes] | PackedVocab,
+        merges: Sequence[Tuple[bytes, bytes]] | PackedMerges,
         special_tokens: Optional[List[str]] = None,
+        backend: str = "auto",
     ):
         """
         初始化 BPE tokenizer。
 
         Args:
-            vocab: 词表，映射 token ID → bytes
-            merges: BPE 合并规则列表，按创建顺序排列
+            vocab: 词表，映射 token ID → bytes（也可以是 PackedVocab，不做拷贝）
+            merges: BPE 合并规则列表，按创建顺序排列（也可以是 PackedMerges，不做拷贝）
             special_tokens: 特殊 token 列表，这些 tokens 不会被拆分
+            backend: 普通文本的编码引擎。"python" 使用纯 Python BPE；
+                "tiktoken" 使用由 merges 构造的 tiktoken Encoding，无法表示时抛出 ValueError；
+                "auto"（默认）在可以表示时使用 tiktoken，否则回退到纯 Python。
+                构造和检查 tiktoken Encoding 需要约 0.5 秒（GPT-2 词表），"auto" 时推迟到第一次编码普通文本，
+                只加载 tokenizer 而不编码（或只解码）的进程不需要付出这部分开销
         """
-        self.vocab = vocab
-        self.merges = merges
+        if backend not in ("auto", "python", "tiktoken"):
+            raise ValueError(f"backend must be 'auto', 'python' or 'tiktoken', got {backend!r}")
         self.special_tokens = special_tokens or []
 
-        # 构建 bytes → token ID 的反向映射
-        self.decoder = {v: k for k, v in vocab.items()}
+        # 词表和 merges 都以紧凑的数组形式保存（见 packed_vocab），对外仍表现为 dict / list
+        token_to_id: Mapping[bytes, int]
+        if isinstance(vocab, PackedVocab):
+            packed_vocab = vocab
+            token_to_id = vocab.inverse()
+        else:
+            token_to_id = {v: k for k, v in vocab.items()}
+            packed_vocab = PackedVocab.from_dict(vocab)
+        if isinstance(merges, PackedMerges):
+            packed_merges = merges
+        else:
+            packed_merges = PackedMerges.from_pairs(merges, token_to_id, packed_vocab)
+        self.vocab: PackedVocab = packed_vocab
+        self.merges: PackedMerges = packed_merges
+
+        # bytes → token ID 的反向映射（基于哈希索引的只读视图）
+        self.decoder = packed_vocab.inverse()
+
+        # 每个单字节对应的 token ID，BPE 从这些 ID 开始合并
+        self._byte_ids = [token_to_id.get(bytes([b])) for b in range(256)]
 
         # 构建用于快速查找的 merge 字典
-        # merge_map[(token_a, token_b)] = merged_token_id
-        self.merge_map = {}
-        for token_a, token_b in merges:
-            merged = token_a + token_b
-            self.merge_map[(token_a, token_b)] = self.decoder[merged]
+        # _merge_ranks[(左 ID << 32) | 右 ID] = (优先级 << 32) | 合并结果 ID
+        # 优先级在高位，因此直接比较数值就能选出优先级最高（merges 中最先出现）的 pair
+        pairs = packed_merges.pairs.astype(np.int64)
+        keys = (pairs[:, 0] << 32) | pairs[:, 1]
+        values = (np.arange(len(pairs), dtype=np.int64) << 32) | pairs[:, 2]
+        self._merge_ranks: Dict[int, int] = dict(zip(keys.tolist(), values.tolist()))
+
+        # 预分词缓存：pretoken（str 或 UTF-8 bytes）→ token IDs，自然语言中高频词会反复出现
+        self._cache: Dict[str, List[int]] = {}
 
         # 处理特殊 tokens
         self.special_token_ids = {}
         for token_str in self.special_tokens:
-            token_bytes = token_str.encode("utf-8")
-            if token_bytes in self.decoder:
-                self.special_token_ids[token_str] = self.decoder[token_bytes]
+            token_id = token_to_id.get(token_str.encode("utf-8"))
+            if token_id is not None:
+                self.special_token_ids[token_str] = token_id
+
+        # 特殊 token 匹配器只在构造时构建一次（最长匹配）
+        self._special_matcher = _SpecialTokenMatcher(self.special_tokens)
+
+        # 可选的分阶段统计，默认关闭（见 enable_profiling）
+        self.stats: Optional[TokenizerStats] = None
+
+        # 可选的 tiktoken 引擎，只用于编码特殊 token 之间的普通文本（见 _get_tiktoken）。
+        # _tiktoken_status: None 表示尚未检查，False 表示不能使用，True 表示已经检查过可以使用
+        self._tiktoken: Optional[tiktoken.Encoding] = None
+        self._tiktoken_status: Optional[bool] = False if backend == "python" else None
+        if backend == "tiktoken" and self._get_tiktoken() is None:
+            raise ValueError("vocab and merges cannot be expressed as a tiktoken Encoding")
+
+    @property
+    def backend(self) -> str:
+        """
+        实际使用的编码引擎，"tiktoken" 或 "python"。
+        """
+        return "tiktoken" if self._get_tiktoken() is not None else "python"
 
-    def encode(self, text: str) -> List[int]:
+    def _get_tiktoken(self) -> Optional[tiktoken.Encoding]:
+        """
+        返回 tiktoken Encoding，第一次调用时构建（并检查与纯 Python 实现等价）；不能使用 tiktoken 时返回 None。
+        """
+        if self._tiktoken is None and self._tiktoken_status is not False:
+            self._tiktoken = self._build_tiktoken_encoding(verify=self._tiktoken_status is None)
+            self._tiktoken_status = self._tiktoken is not None
+        return self._tiktoken
+
+    def _build_tiktoken_encoding(self, verify: bool = True) -> Optional[tiktoken.Encoding]:
+        """
+        把词表和 merges 转换为 tiktoken Encoding，无法等价表示时返回 None。
+        verify=False 时跳过下面逐个编码 merge 结果的检查（已经检查过的 tokenizer 被反序列化时）。
+
+        tiktoken 以 token ID 作为合并优先级（ID 越小越先合并），因此要求：
+        256 个单字节都在词表中，merges 的结果 ID 随优先级严格递增，
+        并且除单字节和特殊 token 之外的每个 token 都是某条 merge 的结果（否则 tiktoken 可能产生它）。
+
+        此外，tiktoken 会合并任何拼接结果在词表中的相邻 token 对，而纯 Python 实现只应用 merges 中的 pair：
+        例如 merges 为 [(b, c), (a, b), (ab, c)] 时，"abc" 先合并为 a + bc，Python 实现到此为止，
+        tiktoken 却会继续合并为 abc。因此还要求每个 merge 结果的字节按 merges 编码后恰好得到它自身
+        （对 GPT-2 词表约需 0.5 秒）。
+        """
+        if any(token_id is None for token_id in self._byte_ids):
+            return None
+        results = self.merges.pairs[:, 2].astype(np.int64)
+        if np.any(np.diff(results) <= 0):
+            return None
+
+        lengths = np.diff(self.vocab.offsets)
+        byte_ids = np.flatnonzero(lengths == 1)
+        extra = np.setdiff1d(np.flatnonzero(lengths > 1), results)
+        if not set(extra.tolist()) <= set(self.special_token_ids.values()):
+            return None
+
+        blob = self.vocab.blob.tobytes()
+        offsets = self.vocab.offsets.tolist()
+        mergeable_ranks = {
+            blob[offsets[token_id] : offsets[token_id + 1]]: token_id
+            for token_id in np.union1d(byte_ids, results).tolist()
+        }
+        # 重复的 bytes 无法用 rank 表示
+        if len(mergeable_ranks) != len(byte_ids) + len(results):
+            return None
+        # 特殊 token 由 _special_matcher 负责切分，tiktoken 只编码普通文本
+        encoding = tiktoken.Encoding(
+            name=f"cs336-bpe-{id(self):x}",
+            pat_str=GPT2_SPLIT_PATTERN,
+            mergeable_ranks=mergeable_ranks,
+            special_tokens={},
+        )
+        if verify:
+            for token_id in results.tolist():
+                if self._encode_bytes(blob[offsets[token_id] : offsets[token_id + 1]]) != [token_id]:
+                    return None
+        return encoding
+
+    def __getstate__(self) -> dict:
+        # tiktoken Encoding 不能直接序列化，反序列化后在第一次编码时重新构建（检查结果随 _tiktoken_status 保留）
+        state = self.__dict__.copy()
+        state["_tiktoken"] = None
+        return state
+
+    @classmethod
+    def from_files(
+        cls,
+        vocab_filepath: str | os.PathLike,
+        merges_filepath: str | os.PathLike,
+        special_tokens: Optional[List[str]] = None,
+        cache_path: Optional[str | os.PathLike] = None,
+        backend: str = "auto",
+    ) -> "Tokenizer":
+        """
+        从 GPT-2 格式的 vocab.json 和 merges.txt 构建 tokenizer。
+
+        不在词表中的特殊 token 会被追加到词表末尾。
+        如果给出 cache_path，则优先从该二进制缓存加载（缓存比两个源文件都新，且保存的特殊 token 与 special_tokens
+        相同时），否则解析源文件后写入缓存，之后的进程可以直接 mmap 加载。
+
+        Args:
+            vocab_filepath: vocab.json 路径，映射 token 字符串 → token ID
+            merges_filepath: merges.txt 路径，每行一个以空格分隔的 merge
+            special_tokens: 特殊 token 列表
+            cache_path: 可选的二进制缓存路径（见 save / load）
+            backend: 编码引擎，见 __init__
+        """
+        if cache_path is not None and os.path.exists(cache_path):
+            cache_mtime = os.path.getmtime(cache_path)
+            if cache_mtime >= max(os.path.getmtime(vocab_filepath), os.path.getmtime(merges_filepath)):
+                cached = cls.load(cache_path, backend=backend)
+                # 缓存是用另一组特殊 token 构建的（词表中可能缺少追加的特殊 token）时重新构建
+                if cached.special_tokens == (special_tokens or []):
+                    return cached
+
+        byte_decoder = {v: k for k, v in gpt2_bytes_to_unicode().items()}
+        with open(vocab_filepath, encoding="utf-8") as f:
+            vocab = {token_id: bytes(byte_decoder[ch] for ch in token) for token, token_id in json.load(f).items()}
+        merges: List[Tuple[bytes, bytes]] = []
+        with open(merges_filepath, encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip().split(" ")
+                # 跳过空行和 "#version" 之类的注释行
+                if len(parts) != 2 or line.startswith("#version"):
+                    continue
+                left, right = (bytes(byte_decoder[ch] for ch in part) for part in parts)
+                merges.append((left, right))
+
+        if special_tokens:
+            known = set(vocab.values())
+            for token in special_tokens:
+                if token.encode("utf-8") not in known:
+                    vocab[len(vocab)] = token.encode("utf-8")
+
+        tokenizer = cls(vocab, merges, special_tokens, backend)
+        if cache_path is not None:
+            tokenizer.save(cache_path)
+        return tokenizer
+
+    def fingerprint(self) -> bytes:
+        """
+        词表、merges 和特殊 token 的 16 字节摘要，写入 token 分片用于检查分片与 tokenizer 是否匹配。
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.vocab.offsets.astype("<i8").tobytes())
+        digest.update(self.vocab.blob.tobytes())
+        digest.update(self.merges.pairs.astype("<i4").tobytes())
+        digest.update("\x00".join(self.special_tokens).encode("utf-8"))
+        return digest.digest()
+
+    def save(self, path: str | os.PathLike) -> None:
+        """
+        把词表、merges 和特殊 token 保存为单个二进制文件，供 load 通过 mmap 快速加载。
+
+        文件布局（小端序）：头部、token 偏移 (int64[n + 1])、哈希索引 (int32[s])、特殊 token 偏移 (int64[k + 1])、
+        merges (int32[m, 3]，按优先级排列的 (左, 右, 结果) token ID)、token 字节、特殊 token 字节。
+
+        先写入同一目录下的临时文件，再用 os.replace 原子地替换 path：已经通过 load 映射了旧文件的 tokenizer
+        继续使用旧文件的内容，不会读到写了一半的新数据。
+        """
+        vocab, merges = self.vocab, self.merges
+        special_bytes = [token.encode("utf-8") for token in self.special_tokens]
+        special_offsets = np.zeros(len(special_bytes) + 1, dtype="<i8")
+        np.cumsum([len(b) for b in special_bytes], out=special_offsets[1:])
+        special_blob = b"".join(special_bytes)
+
+        tmp_path = f"{os.fspath(path)}.tmp-{os.getpid()}"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(
+                    _TOKENIZER_FILE_HEADER.pack(
+                        TOKENIZER_FILE_MAGIC,
+                        vocab.num_ids,
+                        len(vocab.index),
+                        len(merges),
+                        len(special_bytes),
+                        len(vocab.blob),
+                        len(special_blob),
+                    )
+                )
+                f.write(vocab.offsets.astype("<i8").tobytes())
+                f.write(vocab.index.astype("<i4").tobytes())
+                f.write(special_offsets.tobytes())
+                f.write(merges.pairs.astype("<i4").tobytes())
+                f.write(vocab.blob.tobytes())
+                f.write(special_blob)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(
+        cls, path: str | os.PathLike, special_tokens: Optional[List[str]] = None, backend: str = "auto"
+    ) -> "Tokenizer":
+        """
+        通过 mmap 加载 save 保存的二进制 tokenizer 文件。
+
+        词表、哈希索引和 merges 直接引用 mmap 中的数据，不做拷贝，
+        同一文件被多个进程加载时共享同一份物理内存。
+
+        Args:
+            path: 二进制文件路径
+            special_tokens: 特殊 token 列表，默认使用文件中保存的
+            backend: 编码引擎，见 __init__
+        """
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_ids, index_size, num_merges, num_special, blob_len, special_len = (
+            _TOKENIZER_FILE_HEADER.unpack_from(buf)
+        )
+        if magic != TOKENIZER_FILE_MAGIC:
+            raise ValueError(f"{path} is not a tokenizer file")
+
+        pos = _TOKENIZER_FILE_HEADER.size
+        offsets = np.frombuffer(buf, dtype="<i8", count=num_ids + 1, offset=pos)
+        pos += offsets.nbytes
+        index = np.frombuffer(buf, dtype="<i4", count=index_size, offset=pos)
+        pos += index.nbytes
+        special_offsets = np.frombuffer(buf, dtype="<i8", count=num_special + 1, offset=pos).tolist()
+        pos += 8 * (num_special + 1)
+        pairs = np.frombuffer(buf, dtype="<i4", count=3 * num_merges, offset=pos).reshape(-1, 3)
+        pos += pairs.nbytes
+        blob = np.frombuffer(buf, dtype=np.uint8, count=blob_len, offset=pos)
+        pos += blob_len
+        special_blob = buf[pos : pos + special_len]
+
+        vocab = PackedVocab(blob, offsets, index)
+        merges = PackedMerges(pairs, vocab)
+        if special_tokens is None:
+            special_tokens = [
+                special_blob[special_offsets[i] : special_offsets[i + 1]].decode("utf-8") for i in range(num_special)
+            ]
+        return cls(vocab, merges, special_tokens, backend)
+
+    def encode(self, text: str, max_tokens: Optional[int] = None) -> List[int]:
         """
         将文本编码为 token ID 列表。
 
         Args:
             text: 要编码的文本
+            max_tokens: 可选的 token 数上限，结果等于完整编码的前 max_tokens 个 token；
+                达到上限后不再继续预分词和合并，开销只与 max_tokens 有关
 
         Returns:
             token ID 列表
         """
-        tokens = []
+        if max_tokens is not None:
+            return self._encode_truncated(text, max_tokens)
+        stats = self.stats
+        clock = time.perf_counter
+        start = clock() if stats is not None else 0.0
 
         # 先按特殊 tokens 切分
-        if self.special_tokens:
-            # 按最长的特殊 token 优先匹配（贪婪匹配）
-            sorted_special = sorted(self.special_tokens, key=len, reverse=True)
-            pattern = '|'.join(re.escape(token) for token in sorted_special)
-            segments = re.split(f'({pattern})', text)
-        else:
-            segments = [text]
+        matches = list(self._special_matcher.finditer(text))
+        if stats is not None:
+            stats.special_split_time += clock() - start
 
-        for segment in segments:
-            # 如果是特殊 token，直接添加其 ID
-            if segment in self.special_token_ids:
-                tokens.append(self.special_token_ids[segment])
-                continue
+        tokens: List[int] = []
+        pos = 0
+        for match in matches:
+            self._encode_ordinary(text[pos:match.start()], tokens, stats)
+            self._encode_special(match.group(), tokens, stats)
+            pos = match.end()
+        self._encode_ordinary(text[pos:], tokens, stats)
 
-            # 如果是空字符串，跳过
-            if not segment:
-                continue
+        if stats is not None:
+            stats.total_time += clock() - start
+            stats.calls += 1
+            stats.bytes_in += len(text.encode("utf-8"))
+            stats.tokens_out += len(tokens)
+            stats.special_tokens += len(matches)
+        return tokens
 
-            # 使用 GPT-2 正则进行预分词
-            words = re.findall(GPT2_SPLIT_PATTERN, segment)
+    def enable_profiling(self) -> TokenizerStats:
+        """
+        开启 encode 的分阶段统计，返回累积统计的 TokenizerStats（可以调用 reset 清零）。
+        关闭时 encode 只多几次 None 判断，几乎没有额外开销。
+        """
+        if self.stats is None:
+            self.stats = TokenizerStats()
+        return self.stats
 
-            for word in words:
-                if not word:
-                    continue
-                # 将单词转为 bytes，然后进行 BPE 编码
-                word_bytes = word.encode("utf-8")
-                tokens.extend(self._encode_bytes(word_bytes))
+    def disable_profiling(self) -> None:
+        self.stats = None
 
+    def _encode_truncated(self, text: str, max_tokens: int) -> List[int]:
+        if max_tokens < 0:
+            raise ValueError(f"max_tokens must be non-negative, got {max_tokens}")
+        tokens: List[int] = []
+        if max_tokens == 0:
+            return tokens
+        # 按窗口逐步编码，窗口大小按平均每个 token 约 4 个字符估计
+        for window_tokens in self._encode_windows(text, max(4 * max_tokens, 64)):
+            tokens.extend(window_tokens)
+            if len(tokens) >= max_tokens:
+                break
+        del tokens[max_tokens:]
         return tokens
 
+    def count_tokens(self, text: str) -> int:
+        """
+        计算 text 编码后的 token 数，等于 len(encode(text))，但不构造 token ID 列表。
+        """
+        count = 0
+        pos = 0
+        for match in self._special_matcher.finditer(text):
+            count += self._count_ordinary(text[pos:match.start()])
+            token = match.group()
+            count += 1 if token in self.special_token_ids else self._count_ordinary(token)
+            pos = match.end()
+        return count + self._count_ordinary(text[pos:])
+
+    def _count_ordinary(self, text: str) -> int:
+        if self._get_tiktoken() is not None:
+            ids = self._encode_with_tiktoken(text)
+            if ids is not None:
+                return len(ids)
+        return sum(map(len, map(self._encode_word, GPT2_SPLIT_RE.findall(text))))
+
+    def encode_to_array(
+        self, text: str, dtype: Optional[npt.DTypeLike] = None, out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """
+        将文本直接编码为 NumPy 数组，不构造整段文本的 Python 列表。
+
+        Args:
+            text: 要编码的文本
+            dtype: 结果的整数类型，默认按词表大小选择 uint16 或 uint32
+            out: 可选的预分配一维数组，结果从开头写入；空间不足时抛出 ValueError
+
+        Returns:
+            token ID 数组；给出 out 时返回 out[:n] 视图
+        """
+        if dtype is None:
+            dtype = out.dtype if out is not None else token_dtype(self.vocab.num_ids)
+        dtype = np.dtype(dtype)
+        if dtype.kind not in "iu":
+            raise ValueError(f"dtype must be an integer type, got {dtype}")
+
+        blocks: List[np.ndarray] = []
+        count = 0
+
+        def flush(tokens: List[int]) -> None:
+            nonlocal count
+            ids = np.array(tokens, dtype=dtype)
+            if out is not None:
+                if count + len(ids) > len(out):
+                    raise ValueError(f"out has room for {len(out)} tokens, but the text needs more")
+                out[count : count + len(ids)] = ids
+            else:
+                blocks.append(ids)
+            count += len(ids)
+
+        # 每个窗口的结果立即转存为数组，中间的 Python 列表最多只包含一个窗口的 token
+        for tokens in self._encode_windows(text, _ARRAY_BLOCK_SIZE):
+            flush(tokens)
+
+        if out is not None:
+            return out[:count]
+        if not blocks:
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+
+    def encode_bytes(self, data: bytes | memoryview) -> List[int]:
+        """
+        对 UTF-8 字节进行编码，结果与 encode(bytes(data).decode("utf-8")) 相同。
+        data 可以是 bytes、memoryview 或 mmap，直接从缓冲区解码，不会先拷贝出一份 bytes。
+
+        Args:
+            data: UTF-8 编码的文本（bytes、memoryview、mmap 等）
+
+        Returns:
+            token ID 列表
+
+        Raises:
+            UnicodeDecodeError: data 不是合法的 UTF-8
+        """
+        return self.encode(str(data, "utf-8"))
+
+    def _encode_windows(self, text: str, window_size: int) -> Iterator[List[int]]:
+        """
+        以约 window_size 个字符为窗口，和 encode_iterable 一样逐段编码 text，依次产出每段的 token IDs。
+        """
+        tail = ""
+        pos = 0
+        while pos < len(text):
+            # 新读入的字符数不少于保留部分，保证总工作量是线性的
+            step = max(window_size, len(tail))
+            window = tail + text[pos : pos + step]
+            pos += step
+            if pos >= len(text):
+                yield self.encode(window)
+                return
+            tokens: List[int] = []
+            tail = self._encode_prefix(window, tokens)
+            yield tokens
+
+    def _encode_ordinary(self, text: str, tokens: List[int], stats: Optional[TokenizerStats] = None) -> None:
+        """
+        对不含特殊 token 的文本进行预分词和 BPE 编码，结果追加到 tokens。
+        给出 stats 时把各阶段耗时和计数累加进去。
+        """
+        if self._get_tiktoken() is not None:
+            if stats is None:
+                ids = self._encode_with_tiktoken(text)
+            else:
+                t = time.perf_counter()
+                ids = self._encode_with_tiktoken(text)
+                stats.tiktoken_time += time.perf_counter() - t
+            if ids is not None:
+                tokens.extend(ids)
+                return
+        if stats is not None:
+            self._encode_words_profiled(text, tokens, stats)
+            return
+        # 使用 GPT-2 正则进行预分词
+        for word in GPT2_SPLIT_RE.findall(text):
+            tokens.extend(self._encode_word(word))
+
+    def _encode_words_profiled(self, text: str, tokens: List[int], stats: TokenizerStats) -> None:
+        """
+        _encode_ordinary 的纯 Python 路径，同时统计预分词、缓存和合并。
+        """
+        clock = time.perf_counter
+        t = clock()
+        words = GPT2_SPLIT_RE.findall(text)
+        stats.pretokenize_time += clock() - t
+        stats.pretokens += len(words)
+        stats.pretoken_lengths.update(map(len, words))
+        if words:
+            stats.longest_pretoken = max(stats.longest_pretoken, max(map(len, words)))
+
+        # 查缓存和拼接列表的时间 = 整个循环的时间 - BPE 合并的时间（由 _encode_word 累加）
+        misses = stats.cache_misses
+        merge_time = stats.merge_time
+        t = clock()
+        for word in words:
+            tokens.extend(self._encode_word(word, stats))
+        stats.build_time += clock() - t - (stats.merge_time - merge_time)
+        stats.cache_hits += len(words) - (stats.cache_misses - misses)
+
+    def _encode_with_tiktoken(self, text: str) -> Optional[List[int]]:
+        """
+        用 tiktoken 编码普通文本；tiktoken 无法处理时返回 None，由调用方退回纯 Python。
+        """
+        encoding = self._get_tiktoken()
+        if encoding is None or _has_long_whitespace_run(text):
+            return None
+        return encoding.encode_ordinary(text)
+
+    def _encode_special(self, token: str, tokens: List[int], stats: Optional[TokenizerStats] = None) -> None:
+        """
+        追加一个特殊 token 的 ID；不在词表中的特殊 token 按普通文本编码。
+        """
+        if token in self.special_token_ids:
+            tokens.append(self.special_token_ids[token])
+        else:
+            self._encode_ordinary(token, tokens, stats)
+
+    def _encode_word(self, word: str, stats: Optional[TokenizerStats] = None) -> List[int]:
+        """
+        对单个 pretoken 进行 BPE 编码，结果会被缓存；给出 stats 时统计缓存未命中和合并耗时。
+        """
+        ids = self._cache.get(word)
+        if ids is None:
+            # 将单词转为 bytes，然后进行 BPE 编码
+            if stats is None:
+                ids = self._encode_bytes(word.encode("utf-8"))
+            else:
+                t = time.perf_counter()
+                ids = self._encode_bytes(word.encode("utf-8"))
+                stats.merge_time += time.perf_counter() - t
+                stats.cache_misses += 1
+            if len(self._cache) >= PRETOKEN_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[word] = ids
+        return ids
+
     def _encode_bytes(self, word_bytes: bytes) -> List[int]:
         """
         对单个 word_bytes 进行 BPE 编码。
@@ -94,44 +773,38 @@ class Tokenizer:
             return []
 
         # 初始时，每个字节是一个 token
-        parts = [bytes([b]) for b in word_bytes]
+        byte_ids = self._byte_ids
+        parts = [byte_ids[b] for b in word_bytes]
 
         # 贪婪合并：按照 merges 列表中的顺序
         # merges 列表是按优先级排序的（先添加的优先级高）
+        merge_ranks = self._merge_ranks
         while len(parts) > 1:
             # 在所有可能的合并中，选择优先级最高的（merges 列表中先出现的）
-            best_pair = None
-            best_pair_index = -1
-            best_priority = len(self.merges)  # 默认优先级最低
-
+            best = None
+            best_index = -1
             for i in range(len(parts) - 1):
-                pair = (parts[i], parts[i + 1])
-                if pair in self.merge_map:
-                    # 找到这个 pair 在 merges 列表中的索引
-                    # 索引越小，优先级越高
-                    for priority, (p1, p2) in enumerate(self.merges):
-                        if p1 == pair[0] and p2 == pair[1]:
-                            if priority < best_priority:
-                                best_priority = priority
-                                best_pair = pair
-                                best_pair_index = i
-                            break
-
-            if best_pair is None:
+                value = merge_ranks.get((parts[i] << 32) | parts[i + 1])
+                if value is not None and (best is None or value < best):
+                    best = value
+                    best_index = i
+
+            if best is None:
                 break
 
             # 执行合并
-            merged_bytes = best_pair[0] + best_pair[1]
-            parts[best_pair_index:best_pair_index+2] = [merged_bytes]
+            parts[best_index : best_index + 2] = [best & 0xFFFFFFFF]
 
-        # 将 parts 转为 token IDs
-        return [self.decoder[p] for p in parts]
+        return parts
 
-    def encode_iterable(self, iterable: Iterable) -> Iterator[int]:
+    def encode_iterable(self, iterable: Iterable[str]) -> Iterator[int]:
         """
         流式编码，适用于处理大文件。
 
         逐块读取输入并产生 token IDs，避免将整个文件加载到内存。
+        只保留尚未确定的末尾部分（最后一个 pretoken，以及可能是未读完的特殊 token 的后缀），
+        并且只有当新读入的数据不少于保留部分时才重新扫描，
+        因此总工作量是 O(输入长度)，内存占用受最长 pretoken 限制。输出与 encode() 完全一致。
 
         Args:
             iterable: 可迭代对象，可以是文件对象或字符串列表
@@ -139,87 +812,274 @@ class Tokenizer:
         Yields:
             token IDs
         """
-        buffer = ""
+        tail = ""
+        pending: List[str] = []
+        pending_len = 0
 
         for chunk in iterable:
             # 如果是文件对象，chunk 是一行
             # 如果是字符串迭代器，chunk 是一个字符串
-            buffer += chunk
-
-            # 处理 buffer 中的完整 tokens
-            # 我们需要确保不会在特殊 token 中间切断
-            # 简单策略：按特殊 token 切分
-
-            if self.special_tokens:
-                sorted_special = sorted(self.special_tokens, key=len, reverse=True)
-                pattern = '|'.join(re.escape(token) for token in sorted_special)
-
-                # 查找所有特殊 token 的位置
-                for match in re.finditer(pattern, buffer):
-                    # 处理特殊 token 之前的部分
-                    before_special = buffer[:match.start()]
-                    if before_special:
-                        words = re.findall(GPT2_SPLIT_PATTERN, before_special)
-                        for word in words:
-                            if word:
-                                word_bytes = word.encode("utf-8")
-                                for token_id in self._encode_bytes(word_bytes):
-                                    yield token_id
-
-                    # 产出特殊 token
-                    special_token = match.group()
-                    if special_token in self.special_token_ids:
-                        yield self.special_token_ids[special_token]
-
-                    # 更新 buffer
-                    buffer = buffer[match.end():]
-
-                # 处理剩余部分（不包含特殊 token）
-                if buffer:
-                    words = re.findall(GPT2_SPLIT_PATTERN, buffer)
-                    for word in words[:-1]:  # 处理除最后一个外的所有单词
-                        if word:
-                            word_bytes = word.encode("utf-8")
-                            for token_id in self._encode_bytes(word_bytes):
-                                yield token_id
-                    if words:
-                        buffer = words[-1] if words else ""
-                    else:
-                        buffer = ""
-            else:
-                # 没有特殊 token，直接处理
-                words = re.findall(GPT2_SPLIT_PATTERN, buffer)
-                for word in words[:-1]:
-                    if word:
-                        word_bytes = word.encode("utf-8")
-                        for token_id in self._encode_bytes(word_bytes):
-                            yield token_id
-                if words:
-                    buffer = words[-1] if words else ""
-
-        # 处理剩余的 buffer
-        if buffer:
-            words = re.findall(GPT2_SPLIT_PATTERN, buffer)
-            for word in words:
-                if word:
-                    word_bytes = word.encode("utf-8")
-                    for token_id in self._encode_bytes(word_bytes):
-                        yield token_id
-
-    def decode(self, ids: List[int]) -> str:
-        """
-        将 token ID 列表解码为文本。
+            pending.append(chunk)
+            pending_len += len(chunk)
+            if pending_len < len(tail):
+                continue
+
+            text = tail + "".join(pending)
+            pending.clear()
+            pending_len = 0
+
+            tokens: List[int] = []
+            tail = self._encode_prefix(text, tokens)
+            yield from tokens
+
+        # 输入结束，剩余部分已经完整，直接编码
+        yield from self.encode(tail + "".join(pending))
+
+    def encode_prefix(self, text: str) -> Tuple[List[int], str]:
+        """
+        流式编码的一步：编码 text 中之后的输入不会再影响的部分。
+
+        把返回的末尾部分和之后读入的数据拼接后再次调用，输入结束时对末尾部分调用 encode，
+        得到的 token 序列与对完整文本调用 encode 的结果一致（encode_iterable 就是这样实现的）。
+
+        Args:
+            text: 目前读入、尚未编码的文本
+
+        Returns:
+            (已确定的 token ID 列表, 尚未确定的末尾部分)
+        """
+        tokens: List[int] = []
+        tail = self._encode_prefix(text, tokens)
+        return tokens, tail
+
+    def _encode_prefix(self, text: str, tokens: List[int]) -> str:
+        """
+        编码 text 中之后的输入不会再影响的部分，结果追加到 tokens，返回尚未确定的末尾部分。
+        """
+        matcher = self._special_matcher
+        special_spans = [match.span() for match in matcher.finditer(text)]
+
+        # 末尾可能是一个未读完的特殊 token（或者可以继续延长成更长的特殊 token），先保留
+        hold = len(text)
+        for start in range(max(0, len(text) - matcher.max_len + 1), len(text)):
+            if not matcher.is_partial(text, start):
+                continue
+            # 位于已匹配特殊 token 内部的位置不可能成为新匹配的起点
+            if any(s < start < e for s, e in reversed(special_spans[-matcher.max_len :])):
+                continue
+            hold = start
+            break
+
+        pos = 0
+        for start, end in special_spans:
+            if start >= hold:
+                break
+            self._encode_ordinary(text[pos:start], tokens)
+            self._encode_special(text[start:end], tokens)
+            pos = end
+
+        # 最后一个 pretoken 可能会被之后的输入延长，留到下一次处理
+        # GPT-2 正则的匹配首尾相接、覆盖全部文本，因此最后一个 pretoken 恰好在 hold 处结束
+        if self._get_tiktoken() is not None:
+            # 非空白字符之后紧跟空白字符的位置一定是 pretoken 边界，并且在此截断不改变之前的预分词，
+            # 之前的部分交给 tiktoken，只有之后的少量 pretoken 需要逐个处理
+            match = _LAST_BOUNDARY_RE.search(text, pos, hold)
+            ids = self._encode_with_tiktoken(text[pos : match.start() + 1]) if match else None
+            if ids is not None:
+                tokens.extend(ids)
+                pos = match.start() + 1
+
+        words = GPT2_SPLIT_RE.findall(text, pos, hold)
+        if not words:
+            return text[pos:]
+        for word in words[:-1]:
+            tokens.extend(self._encode_word(word))
+        return text[hold - len(words[-1]) :]
+
+    def decode(self, ids: Iterable[int]) -> str:
+        """
+        将 token ID 序列解码为文本。
 
         Args:
-            ids: token ID 列表
+            ids: token ID 序列，可以是列表、一维 NumPy 数组或 torch 张量
 
         Returns:
             解码后的文本
         """
-        # 简单地将每个 ID 对应的 bytes 拼接
-        result_bytes = b""
-        for token_id in ids:
-            if token_id in self.vocab:
-                result_bytes += self.vocab[token_id]
+        return self._ids_to_bytes(ids).decode("utf-8", errors="replace")
+
+    def decode_batch(self, batch: Iterable[Iterable[int]]) -> List[str]:
+        """
+        批量解码多个 token ID 序列。
+
+        Args:
+            batch: token ID 序列的列表，或二维 NumPy 数组 / torch 张量
+
+        Returns:
+            每个序列解码后的文本
+        """
+        if hasattr(batch, "tolist"):
+            batch = batch.tolist()
+        return [self.decode(ids) for ids in batch]
+
+    def streaming_decoder(self) -> "StreamingDecoder":
+        """
+        创建一个增量解码器，用于逐 token 生成时的解码。
+        """
+        return StreamingDecoder(self)
+
+    def incremental_encoder(self, text: str = "") -> "IncrementalEncoder":
+        """
+        创建一个增量编码器，文本被编辑后只重新编码受影响的部分。
+        """
+        return IncrementalEncoder(self, text)
+
+    def _ids_to_bytes(self, ids: Iterable[int]) -> bytes:
+        """
+        把 token IDs 映射为 bytes，并一次性拼接（在紧凑词表上向量化完成）。
+        """
+        if not isinstance(ids, np.ndarray):
+            if hasattr(ids, "tolist"):
+                # torch 张量等：一次性转换为 Python 列表，避免逐元素访问
+                ids = ids.tolist()
+            elif not isinstance(ids, (list, tuple)):
+                ids = list(ids)
+            ids = np.array(ids, dtype=np.int64)
+        return self.vocab.join(ids)
+
+
+class StreamingDecoder:
+    """
+    有状态的增量解码器：每次输入一个 token ID，只返回新完成的文本。
+
+    被拆分到多个 token 中的多字节 UTF-8 字符会暂存在增量解码器中，
+    直到字符完整才输出，因此不会产生 U+FFFD。每个 token 的解码代价与已生成的长度无关。
+    """
+
+    def __init__(self, tokenizer: Tokenizer):
+        self._vocab = tokenizer.vocab
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def step(self, token_id: int) -> str:
+        """
+        输入一个 token ID，返回因此新完成的文本（可能为空字符串）。
+        """
+        return self._decoder.decode(self._vocab.get(int(token_id), b""))
+
+    def flush(self) -> str:
+        """
+        结束当前序列：返回剩余的不完整字节（以 U+FFFD 替代），并重置状态。
+        """
+        text = self._decoder.decode(b"", final=True)
+        self._decoder.reset()
+        return text
+
+    def reset(self) -> None:
+        """
+        丢弃暂存的字节，开始解码新的序列。
+        """
+        self._decoder.reset()
+
+
+class IncrementalEncoder:
+    """
+    增量编码器：保存文本的每个 pretoken（或特殊 token）的起始位置和对应的 token IDs，
+    文本被编辑后只重新编码编辑位置附近的 pretoken，结果始终与 tokenizer.encode(text) 完全一致。
+
+    GPT-2 预分词的每次匹配只依赖于它之后的文本（最多向后多看一个字符），
+    因此编辑点之前足够远的 pretoken 边界仍然有效：从那里开始重新扫描，
+    直到新的边界越过编辑区域并与旧边界（平移后）重合，之后的部分可以直接复用。
+    """
+
+    def __init__(self, tokenizer: Tokenizer, text: str = "", margin: int = 0):
+        """
+        Args:
+            tokenizer: 用于编码的 tokenizer
+            text: 初始文本
+            margin: 在必要的重新扫描范围之外，额外多重新编码的 pretoken 数（只影响速度，不影响结果）
+        """
+        if margin < 0:
+            raise ValueError(f"margin must be non-negative, got {margin}")
+        self._tokenizer = tokenizer
+        self._margin = margin
+        self._text = ""
+        self._starts = np.zeros(0, dtype=np.int64)
+        self._pieces: List[List[int]] = []
+        self._ids: Optional[List[int]] = None
+        if text:
+            self.edit(0, 0, text)
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    @property
+    def ids(self) -> List[int]:
+        """
+        当前文本的 token IDs，等于 tokenizer.encode(text)。
+        """
+        if self._ids is None:
+            self._ids = list(itertools.chain.from_iterable(self._pieces))
+        return self._ids
+
+    def edit(self, offset: int, deleted: int, inserted: str) -> None:
+        """
+        把 text[offset:offset + deleted] 替换为 inserted，并更新 token IDs。
+
+        Args:
+            offset: 编辑位置（字符下标）
+            deleted: 删除的字符数
+            inserted: 插入的文本
+        """
+        old_text = self._text
+        if not 0 <= offset <= len(old_text) or deleted < 0 or offset + deleted > len(old_text):
+            raise ValueError(f"edit ({offset}, {deleted}) is out of range for text of length {len(old_text)}")
+        text = old_text[:offset] + inserted + old_text[offset + deleted :]
+        delta = len(inserted) - deleted
+        edit_end = offset + len(inserted)
+
+        # safe 之前的字符（包括可能匹配特殊 token 的范围）都没有被修改。
+        # 一个 pretoken 的边界还取决于它结尾之后的字符（\s+(?!\S) 会多看一个字符），
+        # 所以从起点不超过 safe 的最后一个 pretoken 再往前退一个 pretoken，它之前的边界才保证不变
+        starts = self._starts
+        safe = offset - self._tokenizer._special_matcher.max_len - 1
+        first = max(int(np.searchsorted(starts, safe, side="right")) - 2 - self._margin, 0)
+        restart = int(starts[first]) if first < len(starts) else 0
+
+        new_starts: List[int] = []
+        new_pieces: List[List[int]] = []
+        resume = len(starts)
+        for start, ids in self._scan(text, restart):
+            if start >= edit_end:
+                # 越过编辑区域后，一旦和某个旧边界重合，之后的结果与旧结果相同
+                j = int(np.searchsorted(starts, start - delta))
+                if j < len(starts) and starts[j] == start - delta:
+                    resume = j
+                    break
+            new_starts.append(start)
+            new_pieces.append(ids)
+
+        self._starts = np.concatenate(
+            [starts[:first], np.array(new_starts, dtype=np.int64), starts[resume:] + delta]
+        )
+        self._pieces[first:resume] = new_pieces
+        self._text = text
+        self._ids = None
+
+    def _scan(self, text: str, pos: int) -> Iterator[Tuple[int, List[int]]]:
+        """
+        从 pretoken 边界 pos 开始，依次产出每个 pretoken（或特殊 token）的起始位置和 token IDs。
+        """
+        tokenizer = self._tokenizer
+        for match in tokenizer._special_matcher.finditer(text, pos):
+            yield from self._scan_ordinary(text, pos, match.start())
+            ids: List[int] = []
+            tokenizer._encode_special(match.group(), ids)
+            yield match.start(), ids
+            pos = match.end()
+        yield from self._scan_ordinary(text, pos, len(text))
 
-        return result_bytes.decode("utf-8", errors="replace")
+    def _scan_ordinary(self, text: str, pos: int, end: int) -> Iterator[Tuple[int, List[int]]]:
+        encode_word = self._tokenizer._encode_word
+        for match in GPT2_SPLIT_RE.finditer(text, pos, end):
+            yield match.start(), encode_word(match.group())
@@ -0,0 +1,435 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import struct
+import threading
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any
+
+from cs336_basics.tokenizer import Tokenizer
+
+# 每条消息的前缀：消息体（UTF-8 JSON）的字节数
+_LENGTH = struct.Struct("<I")
+
+# 每个微批次最多包含的请求数，以及收到第一个请求后最多等待多久（秒）凑成一批
+DEFAULT_MAX_BATCH_SIZE = 64
+DEFAULT_MAX_WAIT = 0.002
+
+# 服务支持的操作，参数和返回值都是 JSON 可以表示的类型
+_OPS = ("encode", "decode", "count_tokens", "encode_prefix")
+
+
+# 每个 worker 进程持有一份 tokenizer，只在进程启动时传递一次
+_worker_tokenizer: Tokenizer | None = None
+
+
+def _init_worker(tokenizer: Tokenizer) -> None:
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _run_batch(tokenizer: Tokenizer, op: str, batch: list[list]) -> list[Any]:
+    """
+    用 tokenizer 执行一批同类请求，返回每个请求的结果；单个请求出错时结果为异常对象。
+    """
+    results: list[Any] = []
+    for args in batch:
+        try:
+            if op == "encode":
+                results.append(tokenizer.encode(*args))
+            elif op == "decode":
+                results.append(tokenizer.decode(*args))
+            elif op == "count_tokens":
+                results.append(tokenizer.count_tokens(*args))
+            else:
+                # 流式编码的一步：返回已确定的 token 和尚未确定的末尾部分（见 Tokenizer.encode_prefix）
+                tokens, tail = tokenizer.encode_prefix(*args)
+                results.append([tokens, tail])
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def _run_worker_batch(op: str, batch: list[list]) -> list[Any]:
+    assert _worker_tokenizer is not None, "worker process was not initialized"
+    return _run_batch(_worker_tokenizer, op, batch)
+
+
+def _pack(message: dict[str, Any]) -> bytes:
+    body = json.dumps(message, ensure_ascii=False).encode("utf-8")
+    return _LENGTH.pack(len(body)) + body
+
+
+class TokenizerServer:
+    """
+    在 Unix socket 或本机 TCP 端口上提供 encode / decode / count_tokens 的 tokenizer 服务。
+
+    多个进程共享同一个 tokenizer，避免各自加载词表的内存和预热开销。
+    并发到达的请求先进入队列，按操作类型凑成微批次后交给 worker 进程池执行，
+    一次进程间通信处理一整批请求。每个连接可以流水线地发送多个请求，响应按 id 对应。
+
+    消息格式：4 字节小端长度 + UTF-8 JSON。
+    请求为 {"id": int, "op": str, "args": list}，响应为 {"id": int, "result": ...} 或 {"id": int, "error": str}。
+    """
+
+    def __init__(
+        self,
+        tokenizer: Tokenizer,
+        path: str | os.PathLike | None = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        num_workers: int | None = None,
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_wait: float = DEFAULT_MAX_WAIT,
+    ):
+        """
+        Args:
+            tokenizer: 服务使用的 tokenizer
+            path: Unix socket 路径；为 None 时监听 host:port
+            host: TCP 监听地址
+            port: TCP 端口，0 表示由系统分配（启动后见 address）
+            num_workers: worker 进程数，默认为 CPU 核数；0 表示在服务进程的线程中执行
+            max_batch_size: 每个微批次最多包含的请求数
+            max_wait: 收到第一个请求后最多等待多久（秒）凑成一批
+        """
+        self.tokenizer = tokenizer
+        self.path = os.fspath(path) if path is not None else None
+        self.host = host
+        self.port = port
+        self.num_workers = (os.cpu_count() or 1) if num_workers is None else num_workers
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self._server: asyncio.AbstractServer | None = None
+        self._executor: Executor | None = None
+        self._queue: asyncio.Queue | None = None
+        self._batcher: asyncio.Task | None = None
+        # 正在执行的微批次，保存引用以免任务被回收
+        self._running: set = set()
+        self._writers: set = set()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+
+    @property
+    def address(self) -> str | tuple[str, int]:
+        """
+        客户端连接的地址：Unix socket 路径或 (host, port)。
+        """
+        if self.path is not None:
+            return self.path
+        return self.host, self.port
+
+    async def start(self) -> None:
+        """
+        开始监听并启动 worker 进程池。
+        """
+        if self.num_workers > 0:
+            # 在主进程中完成一次 tiktoken 检查（访问 backend 时进行），worker 反序列化后只需重建 Encoding
+            _ = self.tokenizer.backend
+            self._executor = ProcessPoolExecutor(
+                self.num_workers, initializer=_init_worker, initargs=(self.tokenizer,)
+            )
+        else:
+            self._executor = ThreadPoolExecutor(1)
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.create_task(self._batch_loop())
+        if self.path is not None:
+            self._server = await asyncio.start_unix_server(self._handle_connection, path=self.path)
+        else:
+            self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        assert self._server is not None
+        await self._server.serve_forever()
+
+    async def aclose(self) -> None:
+        """
+        停止监听并关闭 worker 进程池。
+        """
+        if self._server is not None:
+            self._close_connections()
+            await self._server.wait_closed()
+            self._server = None
+        if self._batcher is not None:
+            self._batcher.cancel()
+            self._batcher = None
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def start_in_thread(self) -> "TokenizerServer":
+        """
+        在后台线程的事件循环中运行服务，监听建立后返回，之后用 stop 停止。
+        """
+        started = threading.Event()
+        errors: list[BaseException] = []
+
+        async def run() -> None:
+            try:
+                await self.start()
+            except BaseException as e:
+                errors.append(e)
+                raise
+            finally:
+                started.set()
+            assert self._server is not None
+            await self._server.serve_forever()
+
+        def target() -> None:
+            loop = self._loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(run())
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                # 启动失败的异常由 start_in_thread 在调用线程中抛出
+                if not errors:
+                    raise
+            finally:
+                loop.run_until_complete(self.aclose())
+                loop.close()
+
+        self._thread = threading.Thread(target=target, name="tokenizer-service", daemon=True)
+        self._thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+        return self
+
+    def stop(self) -> None:
+        """
+        停止 start_in_thread 启动的服务。
+        """
+        if self._thread is None:
+            return
+
+        # 关闭监听 socket 会让 serve_forever 退出，之后由后台线程执行 aclose
+        assert self._loop is not None
+        self._loop.call_soon_threadsafe(self._close_connections)
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self) -> "TokenizerServer":
+        return self.start_in_thread()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _close_connections(self) -> None:
+        if self._server is not None:
+            self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        assert queue is not None, "start() must be called before serving connections"
+        pending: set = set()
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(_LENGTH.size)
+                except asyncio.IncompleteReadError:
+                    break
+                (length,) = _LENGTH.unpack(header)
+                request = json.loads(await reader.readexactly(length))
+                future = loop.create_future()
+                op = request.get("op")
+                if op not in _OPS:
+                    future.set_exception(ValueError(f"unknown op {op!r}"))
+                else:
+                    await queue.put((op, request.get("args", []), future))
+                task = asyncio.create_task(self._respond(request.get("id"), future, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _respond(self, request_id: Any, future: asyncio.Future, writer: asyncio.StreamWriter) -> None:
+        try:
+            message = {"id": request_id, "result": await future}
+        except Exception as e:
+            message = {"id": request_id, "error": f"{type(e).__name__}: {e}"}
+        writer.write(_pack(message))
+        await writer.drain()
+
+    async def _batch_loop(self) -> None:
+        """
+        从队列中取出请求，凑成微批次后按操作类型分组提交给 worker。
+        """
+        loop = asyncio.get_running_loop()
+        queue = self._queue
+        assert queue is not None
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except TimeoutError:
+                    break
+
+            groups: dict[str, list] = {}
+            for op, args, future in batch:
+                groups.setdefault(op, []).append((args, future))
+            for op, items in groups.items():
+                task = asyncio.create_task(self._run_group(op, items))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+    async def _run_group(self, op: str, items: list[tuple[list, asyncio.Future]]) -> None:
+        loop = asyncio.get_running_loop()
+        batch = [args for args, _ in items]
+        try:
+            if isinstance(self._executor, ProcessPoolExecutor):
+                results = await loop.run_in_executor(self._executor, _run_worker_batch, op, batch)
+            else:
+                results = await loop.run_in_executor(self._executor, _run_batch, self.tokenizer, op, batch)
+        except Exception as e:
+            results = [e] * len(items)
+        for (_, future), result in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class TokenizerClient:
+    """
+    TokenizerServer 的同步客户端，提供和 Tokenizer 相同的编码 / 解码接口。
+
+    一个客户端持有一个连接，可以在多个线程中共享（请求串行发送）；
+    需要并发时每个线程使用各自的客户端，由服务端合并成微批次。
+    """
+
+    def __init__(self, address: str | os.PathLike | tuple[str, int], timeout: float | None = None):
+        """
+        Args:
+            address: Unix socket 路径或 (host, port)，通常取自 TokenizerServer.address
+            timeout: socket 超时（秒）
+        """
+        if isinstance(address, tuple):
+            self._sock = socket.create_connection(address, timeout=timeout)
+        else:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(timeout)
+            self._sock.connect(os.fspath(address))
+        self._file = self._sock.makefile("rb")
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def _call(self, op: str, *args: Any) -> Any:
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+            self._sock.sendall(_pack({"id": request_id, "op": op, "args": list(args)}))
+            header = self._file.read(_LENGTH.size)
+            if len(header) < _LENGTH.size:
+                raise ConnectionError("tokenizer service closed the connection")
+            (length,) = _LENGTH.unpack(header)
+            response = json.loads(self._file.read(length))
+        if "error" in response:
+            raise RuntimeError(f"tokenizer service error: {response['error']}")
+        return response["result"]
+
+    def encode(self, text: str, max_tokens: int | None = None) -> list[int]:
+        return self._call("encode", text, max_tokens)
+
+    def count_tokens(self, text: str) -> int:
+        return self._call("count_tokens", text)
+
+    def decode(self, ids: Iterable[int]) -> str:
+        return self._call("decode", [int(i) for i in ids])
+
+    def encode_iterable(self, iterable: Iterable[str]) -> Iterator[int]:
+        """
+        流式编码，与 Tokenizer.encode_iterable 的结果一致：尚未确定的末尾部分由客户端保存，
+        和之后读入的数据一起发送。
+        """
+        tail = ""
+        pending: list[str] = []
+        pending_len = 0
+        for chunk in iterable:
+            pending.append(chunk)
+            pending_len += len(chunk)
+            if pending_len < len(tail):
+                continue
+            tokens, tail = self._call("encode_prefix", tail + "".join(pending))
+            pending.clear()
+            pending_len = 0
+            yield from tokens
+        yield from self.encode(tail + "".join(pending))
+
+    def close(self) -> None:
+        self._file.close()
+        self._sock.close()
+
+    def __enter__(self) -> "TokenizerClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a BPE tokenizer over a Unix socket or localhost TCP.")
+    parser.add_argument("--tokenizer", help="binary tokenizer file written by Tokenizer.save")
+    parser.add_argument("--vocab", help="GPT-2 style vocab.json")
+    parser.add_argument("--merges", help="GPT-2 style merges.txt")
+    parser.add_argument("--special-tokens", nargs="*", default=None)
+    parser.add_argument("--socket", help="Unix socket path (default: listen on --host/--port)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait", type=float, default=DEFAULT_MAX_WAIT)
+    args = parser.parse_args()
+
+    if args.tokenizer:
+        tokenizer = Tokenizer.load(args.tokenizer, args.special_tokens)
+    elif args.vocab and args.merges:
+        tokenizer = Tokenizer.from_files(args.vocab, args.merges, args.special_tokens)
+    else:
+        parser.error("either --tokenizer or both --vocab and --merges are required")
+
+    server = TokenizerServer(
+        tokenizer,
+        path=args.socket,
+        host=args.host,
+        port=args.port,
+        num_workers=args.num_workers,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait,
+    )
+
+    async def run() -> None:
+        await server.start()
+        print(f"tokenizer service listening on {server.address}", flush=True)
+        try:
+            await server.serve_forever()
+        finally:
+            await server.aclose()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
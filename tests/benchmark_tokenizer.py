@@ -0,0 +1,208 @@
+"""
+Throughput benchmark for `cs336_basics.tokenizer.Tokenizer`, with tiktoken as the reference.
+
+Reports MB/s and tokens/s for `encode`, `encode_iterable` and `decode` on the tokenizer
+fixtures plus synthetic adversarial inputs, and writes the results as JSON so that runs
+can be compared. Usage:
+
+    uv run python -m tests.benchmark_tokenizer --output bench.json
+    uv run python -m tests.benchmark_tokenizer --baseline bench.json --max-slowdown 0.2
+
+With --baseline, the run exits with status 1 if any (input, implementation, op) got slower
+than the baseline by more than --max-slowdown.
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import json
+import platform
+import sys
+import time
+from collections.abc import Callable
+
+import tiktoken
+
+from cs336_basics.tokenizer import Tokenizer
+
+from .common import FIXTURES_PATH
+
+VOCAB_PATH = FIXTURES_PATH / "gpt2_vocab.json"
+MERGES_PATH = FIXTURES_PATH / "gpt2_merges.txt"
+SPECIAL_TOKENS = ["<|endoftext|>"]
+
+# Name of the implementation whose encode output the others must match
+REFERENCE_IMPL = "tiktoken"
+
+DEFAULT_FIXTURES = ["tinystories_sample_5M.txt", "german.txt", "address.txt", "tinystories_sample.txt", "corpus.en"]
+
+
+def load_inputs(fixtures: list[str], whitespace_size: int, word_size: int) -> dict[str, str]:
+    """
+    Read the fixture texts (missing fixtures are skipped) and build the adversarial inputs:
+    one very long whitespace run, and one very long word, which is the worst case for
+    per-pretoken BPE merging.
+    """
+    inputs = {}
+    for name in fixtures:
+        path = FIXTURES_PATH / name
+        if not path.exists():
+            print(f"skipping missing fixture {name}", file=sys.stderr)
+            continue
+        inputs[name] = path.read_text(encoding="utf-8")
+    inputs["adversarial:long_whitespace"] = " " * whitespace_size + "x"
+    inputs["adversarial:long_word"] = "".join(chr(ord("a") + i % 26) for i in range(word_size))
+    return inputs
+
+
+def load_implementations() -> dict[str, tuple[Callable, Callable | None, Callable]]:
+    """
+    Returns name -> (encode, encode_iterable or None, decode) for every implementation.
+    """
+    implementations = {}
+    for backend in ["python", "tiktoken"]:
+        tokenizer = Tokenizer.from_files(VOCAB_PATH, MERGES_PATH, SPECIAL_TOKENS, backend=backend)
+        implementations[f"Tokenizer[{backend}]"] = (tokenizer.encode, tokenizer.encode_iterable, tokenizer.decode)
+    try:
+        reference = tiktoken.get_encoding("gpt2")
+    except Exception as e:
+        print(f"tiktoken reference unavailable ({type(e).__name__}), skipping it", file=sys.stderr)
+    else:
+        implementations[REFERENCE_IMPL] = (
+            lambda text: reference.encode(text, allowed_special=set(SPECIAL_TOKENS)),
+            None,
+            reference.decode,
+        )
+    return implementations
+
+
+def _best_time(fn: Callable[[], object], repeat: int) -> tuple[float, object]:
+    # One untimed warm-up call (fills pretoken caches), then the best of `repeat` runs
+    result = fn()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def _record(input_name: str, impl: str, op: str, num_bytes: int, num_tokens: int, seconds: float) -> dict:
+    seconds = max(seconds, 1e-9)
+    return {
+        "input": input_name,
+        "impl": impl,
+        "op": op,
+        "bytes": num_bytes,
+        "tokens": num_tokens,
+        "seconds": seconds,
+        "mb_per_s": num_bytes / seconds / 1e6,
+        "tokens_per_s": num_tokens / seconds,
+    }
+
+
+def run_benchmarks(inputs: dict[str, str], implementations: dict, repeat: int = 3) -> list[dict]:
+    """
+    Every encode result is checked against the REFERENCE_IMPL entry when it is present and succeeds on the
+    input, otherwise against the first implementation that succeeds.
+    """
+    # Run the reference first so that its ids are known before the others are compared
+    order = sorted(implementations, key=lambda impl: impl != REFERENCE_IMPL)
+    results = []
+    for input_name, text in inputs.items():
+        num_bytes = len(text.encode("utf-8"))
+        reference_ids = None
+        for impl in order:
+            encode, encode_iterable, decode = implementations[impl]
+            try:
+                seconds, ids = _best_time(lambda: encode(text), repeat)
+            except Exception as e:
+                # e.g. tiktoken's regex gives up on very long whitespace runs
+                results.append({"input": input_name, "impl": impl, "op": "encode", "error": f"{type(e).__name__}: {e}"})
+                print(f"{input_name:<32} {impl:<20} encode failed: {type(e).__name__}", file=sys.stderr)
+                continue
+            record = _record(input_name, impl, "encode", num_bytes, len(ids), seconds)
+            if reference_ids is None:
+                reference_ids = ids
+            record["matches_reference"] = ids == reference_ids
+            results.append(record)
+
+            if encode_iterable is not None:
+                seconds, _ = _best_time(lambda: list(encode_iterable(io.StringIO(text))), repeat)
+                results.append(_record(input_name, impl, "encode_iterable", num_bytes, len(ids), seconds))
+
+            seconds, _ = _best_time(lambda: decode(ids), repeat)
+            results.append(_record(input_name, impl, "decode", num_bytes, len(ids), seconds))
+
+            print(
+                f"{input_name:<32} {impl:<20} "
+                + "  ".join(f"{r['op']} {r['mb_per_s']:8.2f} MB/s" for r in results[-3:] if r["impl"] == impl),
+                file=sys.stderr,
+            )
+    return results
+
+
+def compare(results: list[dict], baseline: list[dict], max_slowdown: float) -> list[str]:
+    """
+    Returns a description of every measurement that is slower than the baseline by more than max_slowdown.
+    """
+    previous = {(r["input"], r["impl"], r["op"]): r for r in baseline}
+    regressions = []
+    for record in results:
+        old = previous.get((record["input"], record["impl"], record["op"]))
+        if old is None or "error" in old:
+            continue
+        if "error" in record:
+            regressions.append(f"{record['input']} {record['impl']} {record['op']}: {record['error']}")
+            continue
+        if record["mb_per_s"] < old["mb_per_s"] * (1 - max_slowdown):
+            regressions.append(
+                f"{record['input']} {record['impl']} {record['op']}: "
+                f"{old['mb_per_s']:.2f} -> {record['mb_per_s']:.2f} MB/s"
+            )
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", nargs="*", default=DEFAULT_FIXTURES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--whitespace-size", type=int, default=1_000_000)
+    parser.add_argument("--word-size", type=int, default=4096)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file from an earlier run to compare against")
+    parser.add_argument("--max-slowdown", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    inputs = load_inputs(args.fixtures, args.whitespace_size, args.word_size)
+    results = run_benchmarks(inputs, load_implementations(), args.repeat)
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+    mismatches = [r for r in results if r.get("matches_reference") is False]
+    for r in mismatches:
+        print(f"MISMATCH: {r['impl']} encode differs from the reference on {r['input']}", file=sys.stderr)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.max_slowdown)
+        for line in regressions:
+            print(f"REGRESSION: {line}", file=sys.stderr)
+    return 1 if mismatches or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+import numpy as np
+
+from cs336_basics.chunking import find_chunk_boundaries, map_chunks, plan_chunks, reduce_chunks
+
+
+def test_find_chunk_boundaries(tmp_path):
+    path = tmp_path / "docs.txt"
+    # The first delimiter straddles the 4KB mini-chunks the reference implementation reads.
+    contents = b"a" * 4090 + b"<|endoftext|>" + b"b" * 5000 + b"<|sep|>" + b"c" * 3000 + b"<|endoftext|>" + b"d" * 500
+    path.write_bytes(contents)
+    boundaries = find_chunk_boundaries(path, 4, [b"<|endoftext|>", b"<|sep|>"])
+    assert boundaries == [0, 4090, 9103, 12110, len(contents)]
+
+    # Fewer delimiters than chunks: every delimiter becomes a boundary, none are duplicated.
+    with open(path, "rb") as f:
+        assert find_chunk_boundaries(f, 16, b"<|endoftext|>") == [0, 4090, 12110, len(contents)]
+    assert find_chunk_boundaries(path, 4, b"<|missing|>") == [0, len(contents)]
+
+    # With a delimiter every 100 bytes, chunks stay within the tolerance of the average size.
+    path.write_bytes(b"".join(b"x" * 87 + b"<|endoftext|>" for _ in range(1000)))
+    boundaries = find_chunk_boundaries(path, 7, b"<|endoftext|>", tolerance=0.05)
+    sizes = np.diff(boundaries)
+    assert len(sizes) == 7
+    assert np.all(np.abs(sizes - 100_000 / 7) <= 0.05 * 100_000 / 7 + 100)
+
+    # Boundaries never fall inside an occurrence of a longer special token that contains the delimiter.
+    contents = b"x" * 1000 + b"<|a|><|a|>" + b"y" * 1000 + b"<|a|>" + b"z" * 1000
+    path.write_bytes(contents)
+    assert find_chunk_boundaries(path, 2, b"<|a|>") == [0, 1005, len(contents)]
+    assert find_chunk_boundaries(path, 2, b"<|a|>", special_tokens=[b"<|a|>", b"<|a|><|a|>"]) == [
+        0,
+        2010,
+        len(contents),
+    ]
+    assert find_chunk_boundaries(path, 3, b"<|a|>", special_tokens=[b"<|a|>", b"<|a|><|a|>"]) == [
+        0,
+        1000,
+        2010,
+        len(contents),
+    ]
+
+
+def _chunk_length(chunk):
+    start, end = chunk
+    return end - start
+
+
+def test_chunk_scheduler(tmp_path):
+    path = tmp_path / "docs.txt"
+    path.write_bytes(b"".join(b"doc %d " % i * (i % 7 + 1) + b"<|endoftext|>" for i in range(500)))
+    chunks = plan_chunks(path, num_processes=2, split_special_tokens=b"<|endoftext|>", tasks_per_process=8)
+    assert len(chunks) == 16
+    assert chunks[0][0] == 0 and chunks[-1][1] == path.stat().st_size
+    assert all(a[1] == b[0] for a, b in zip(chunks[:-1], chunks[1:]))
+
+    lengths = [end - start for start, end in chunks]
+    assert list(map_chunks(_chunk_length, chunks, num_processes=2)) == lengths
+    assert sorted(map_chunks(_chunk_length, chunks, num_processes=2, ordered=False)) == sorted(lengths)
+    assert reduce_chunks(_chunk_length, chunks, num_processes=2) == path.stat().st_size
+    assert reduce_chunks(_chunk_length, [], num_processes=2, initial=0) == 0
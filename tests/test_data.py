@@ -1,10 +1,33 @@
+import json
 import math
 from collections import Counter
 
 import numpy as np
 import pytest
+import torch
+
+from cs336_basics.data import (
+    BatchPrefetcher,
+    BatchSampler,
+    MixtureDataset,
+    TokenBudgetSchedule,
+    document_starts,
+    get_batch,
+    get_budget_batch,
+    get_packed_batch,
+    load_document_starts,
+    load_tokens,
+    num_tokens_in_file,
+    packed_row_starts,
+    segment_attention_mask,
+)
+from cs336_basics.encode_corpus import encode_file
+from cs336_basics.text_loader import TextBatchLoader
+from cs336_basics.token_shard import open_shard, write_shard
+from cs336_basics.tokenizer import Tokenizer
 
 from .adapters import run_get_batch
+from .common import FIXTURES_PATH
 
 
 def test_get_batch():
@@ -70,3 +93,351 @@ def test_get_batch():
             device="cuda:99",
         )
         assert "CUDA error" in str(excinfo.value) or "Torch not compiled with CUDA enabled" in str(excinfo.value)
+
+
+def test_get_batch_from_memmap(tmp_path):
+    tokens = (np.arange(10_000) * 7 % 50_000).astype(np.uint16)
+    tokens.tofile(tmp_path / "tokens.bin")
+    dataset = load_tokens(tmp_path / "tokens.bin", dtype=np.uint16)
+    assert isinstance(dataset, np.memmap)
+
+    x, y = get_batch(dataset, batch_size=16, context_length=9, device="cpu", rng=np.random.default_rng(0))
+    assert x.dtype == y.dtype == torch.long
+    assert x.shape == y.shape == (16, 9)
+    for row_x, row_y in zip(x.numpy(), y.numpy()):
+        start = int(np.flatnonzero(tokens == row_x[0])[0])
+        np.testing.assert_array_equal(row_x, tokens[start : start + 9])
+        np.testing.assert_array_equal(row_y, tokens[start + 1 : start + 10])
+
+    # The same seed gives the same batch.
+    x2, _ = get_batch(dataset, batch_size=16, context_length=9, device="cpu", rng=np.random.default_rng(0))
+    assert torch.equal(x, x2)
+
+
+@pytest.mark.parametrize(
+    "device",
+    ["cpu", pytest.param("cuda", marks=pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA"))],
+)
+def test_batch_prefetcher_matches_get_batch(device):
+    dataset = np.arange(1000, dtype=np.uint16)
+    rng = np.random.default_rng(0)
+    expected = [get_batch(dataset, 8, 16, "cpu", rng=rng) for _ in range(20)]
+    with BatchPrefetcher(dataset, 8, 16, device, rng=np.random.default_rng(0), num_buffers=2) as batches:
+        for expected_x, expected_y in expected:
+            x, y = next(batches)
+            assert x.device.type == device
+            assert torch.equal(x.cpu(), expected_x)
+            assert torch.equal(y.cpu(), expected_y)
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_batch_sampler_resume(shuffle):
+    sampler = BatchSampler(num_tokens=1000, context_length=10, seed=1234, shuffle=shuffle)
+    stream = [sampler.next_starts(32) for _ in range(10)]
+    assert all(np.all((starts >= 0) & (starts < 990)) for starts in stream)
+
+    sampler = BatchSampler(num_tokens=1000, context_length=10, seed=1234, shuffle=shuffle)
+    for _ in range(4):
+        sampler.next_starts(32)
+    state = sampler.state_dict()
+    resumed = BatchSampler(num_tokens=1000, context_length=10, seed=0, shuffle=shuffle)
+    resumed.load_state_dict(state)
+    for expected in stream[4:]:
+        np.testing.assert_array_equal(resumed.next_starts(32), expected)
+
+    with pytest.raises(ValueError):
+        BatchSampler(num_tokens=2000, context_length=10).load_state_dict(state)
+
+
+def test_batch_sampler_shuffle_epochs():
+    sampler = BatchSampler(num_tokens=1000, context_length=10, seed=0, shuffle=True)
+    assert sampler.epoch_size == 99
+    starts = np.concatenate([sampler.next_starts(45) for _ in range(11)])
+    # Every epoch visits each non-overlapping window exactly once, in a different order.
+    for epoch in range(5):
+        assert sorted(starts[epoch * 99 : (epoch + 1) * 99]) == list(range(0, 990, 10))
+    assert not np.array_equal(starts[:99], starts[99:198])
+    assert sampler.epoch == 5
+
+
+def test_batch_sampler_shuffle_short_context():
+    # 15 slots of 64 tokens; a 16-token step splits each slot into 4 consecutive windows.
+    sampler = BatchSampler(num_tokens=1000, context_length=64, seed=5, shuffle=True)
+    assert sampler.epoch_size == 15
+    stream = [sampler.next_starts(7, 16) for _ in range(9)] + [sampler.next_starts(2, 64)]
+    starts = np.concatenate(stream[:9])
+    assert sorted(starts[:60]) == [slot + offset for slot in range(0, 960, 64) for offset in range(0, 64, 16)]
+    np.testing.assert_array_equal(starts[:4], starts[0] + np.arange(0, 64, 16))
+    # The first full-length window after the epoch starts a fresh slot.
+    assert sampler.samples_seen == 18 and stream[9][0] % 64 == 0
+
+    sampler = BatchSampler(num_tokens=1000, context_length=64, seed=5, shuffle=True)
+    for _ in range(3):
+        sampler.next_starts(7, 16)
+    resumed = BatchSampler(num_tokens=1000, context_length=64, seed=0, shuffle=True)
+    resumed.load_state_dict(sampler.state_dict())
+    for expected in stream[3:9]:
+        np.testing.assert_array_equal(resumed.next_starts(7, 16), expected)
+    np.testing.assert_array_equal(resumed.next_starts(2, 64), stream[9])
+
+    with pytest.raises(ValueError, match="context_length"):
+        sampler.next_starts(4, 65)
+
+
+def test_batch_prefetcher_state_dict_skips_prefetched_batches():
+    dataset = np.arange(1000, dtype=np.uint16)
+    reference = BatchSampler(1000, 8, seed=7, shuffle=True)
+    expected = [get_batch(dataset, 4, 8, "cpu", sampler=reference)[0] for _ in range(6)]
+
+    with BatchPrefetcher(dataset, 4, 8, "cpu", sampler=BatchSampler(1000, 8, seed=7, shuffle=True)) as batches:
+        for i in range(3):
+            assert torch.equal(next(batches)[0], expected[i])
+        state = batches.state_dict()
+
+    # The prefetcher sampled ahead, but its state only covers the batches that were consumed.
+    resumed = BatchSampler(1000, 8, seed=7, shuffle=True)
+    resumed.load_state_dict(state)
+    for i in range(3, 6):
+        assert torch.equal(get_batch(dataset, 4, 8, "cpu", sampler=resumed)[0], expected[i])
+
+
+def test_packed_batch_segments():
+    eot = 0
+    # Documents of lengths 5, 1, 12, 3 (each ends with the EOT token), then an unterminated tail.
+    lengths = [5, 1, 12, 3]
+    dataset = np.concatenate([np.append(np.arange(1, n), eot) for n in lengths] + [np.arange(1, 8)]).astype(np.uint16)
+    doc_starts = document_starts(dataset, eot)
+    np.testing.assert_array_equal(doc_starts, [0, 5, 6, 18, 21])
+
+    # Rows start at document starts, or every 8 tokens inside the 12-token document; the tail cannot fill a row.
+    row_starts = packed_row_starts(doc_starts, len(dataset), 8)
+    np.testing.assert_array_equal(row_starts, [0, 5, 6, 14, 18])
+
+    batch = get_packed_batch(dataset, doc_starts, 64, 8, "cpu", rng=np.random.default_rng(0))
+    assert batch.x.shape == batch.segment_ids.shape == batch.position_ids.shape == (64, 8)
+    np.testing.assert_array_equal(batch.y[:, :-1], batch.x[:, 1:])
+    assert set(batch.x[:, 0].tolist()) == set(dataset[row_starts].tolist())
+
+    # In shuffle mode every row start is used exactly once per epoch.
+    sampler = BatchSampler.over_indices(len(row_starts), seed=3, shuffle=True)
+    for _ in range(2):
+        epoch = get_packed_batch(dataset, doc_starts, 5, 8, "cpu", sampler=sampler, row_starts=row_starts)
+        windows = np.lib.stride_tricks.sliding_window_view(dataset, 8)[row_starts]
+        assert sorted(map(tuple, epoch.x.tolist())) == sorted(map(tuple, windows.tolist()))
+    with pytest.raises(ValueError, match="over_indices"):
+        get_packed_batch(dataset, doc_starts, 5, 8, "cpu", sampler=BatchSampler(len(dataset), 8))
+    for x, segments, positions in zip(batch.x, batch.segment_ids, batch.position_ids):
+        assert segments[0] == 0 and positions[0] == 0
+        for i in range(1, 8):
+            new_document = x[i - 1] == eot
+            assert segments[i] == segments[i - 1] + new_document
+            assert positions[i] == (0 if new_document else positions[i - 1] + 1)
+
+    mask = segment_attention_mask(torch.tensor([[0, 0, 1, 1, 1, 2]]))
+    expected = torch.tensor(
+        [
+            [1, 0, 0, 0, 0, 0],
+            [1, 1, 0, 0, 0, 0],
+            [0, 0, 1, 0, 0, 0],
+            [0, 0, 1, 1, 0, 0],
+            [0, 0, 1, 1, 1, 0],
+            [0, 0, 0, 0, 0, 1],
+        ],
+        dtype=torch.bool,
+    )
+    assert torch.equal(mask[0], expected)
+
+
+def test_mixture_dataset(tmp_path):
+    # Shard k holds tokens k * 10000 + [0, n), so every row reveals which shard it came from.
+    sizes = [500, 2000, 300]
+    for k, n in enumerate(sizes):
+        (k * 10000 + np.arange(n)).astype(np.uint16).tofile(tmp_path / f"shard{k}.bin")
+    np.save(tmp_path / "shard3.npy", (30000 + np.arange(400)).astype(np.uint32))
+    manifest = {
+        "shards": [
+            {"path": "shard0.bin", "weight": 0.5},
+            {"path": "shard1.bin", "weight": 0.3},
+            {"path": "shard2.bin", "weight": 0.2},
+            {"path": "shard3.npy", "weight": 0.0, "dtype": "uint32"},
+        ]
+    }
+    (tmp_path / "manifest.json").write_text(json.dumps(manifest))
+    dataset = MixtureDataset.from_manifest(tmp_path / "manifest.json", seed=3, max_open_shards=2)
+    assert dataset.num_tokens.tolist() == [500, 2000, 300, 400]
+
+    counts = Counter()
+    for _ in range(50):
+        x, y = dataset.get_batch(32, 16, "cpu")
+        assert torch.equal(x + 1, y)
+        counts.update((x[:, 0] // 10000).tolist())
+        assert len(dataset._open) <= 2
+    assert set(counts) == {0, 1, 2}
+    assert counts[0] > counts[1] > counts[2]
+
+    # Changing the mixture needs no re-tokenization, and the state restores the exact stream.
+    dataset.set_weights([0, 0, 0, 1])
+    state = dataset.state_dict()
+    x, _ = dataset.get_batch(8, 16, "cpu")
+    assert torch.all(x // 10000 == 3)
+    resumed = MixtureDataset.from_manifest(tmp_path / "manifest.json")
+    resumed.load_state_dict(state)
+    assert torch.equal(resumed.get_batch(8, 16, "cpu")[0], x)
+
+
+def test_token_shard_roundtrip(tmp_path):
+    tokens = np.array([5, 6, 0, 7, 0, 8, 9, 10], dtype=np.uint32)
+    path = tmp_path / "shard.bin"
+    write_shard(path, tokens, document_starts(tokens, 0), vocab_size=70_000, eot_token_id=0, fingerprint=b"abc")
+
+    loaded, doc_starts, header = open_shard(path, fingerprint=b"abc", vocab_size=70_000)
+    assert loaded.dtype == np.uint32
+    np.testing.assert_array_equal(loaded, tokens)
+    np.testing.assert_array_equal(doc_starts, [0, 3, 5])
+    assert header.num_tokens == num_tokens_in_file(path) == 8
+    np.testing.assert_array_equal(load_tokens(path), tokens)
+    np.testing.assert_array_equal(load_document_starts(path, eot_token_id=0), [0, 3, 5])
+
+    with pytest.raises(ValueError, match="vocabulary"):
+        open_shard(path, vocab_size=50_000)
+    with pytest.raises(ValueError, match="different tokenizer"):
+        load_tokens(path, fingerprint=b"xyz")
+    with pytest.raises(ValueError, match="no shard header"):
+        tokens.tofile(tmp_path / "raw.bin")
+        load_tokens(tmp_path / "raw.bin", fingerprint=b"abc")
+    with open(path, "r+b") as f:
+        f.truncate(100)
+    with pytest.raises(ValueError, match="truncated"):
+        open_shard(path)
+
+
+def test_token_budget_schedule():
+    schedule = TokenBudgetSchedule(
+        tokens_per_batch=4096, max_context_length=512, min_context_length=64, warmup_steps=100
+    )
+    shapes = [schedule(step) for step in range(150)]
+    lengths = [context_length for _, context_length in shapes]
+    assert lengths[0] == 64 and lengths[-1] == 512
+    assert lengths == sorted(lengths)
+    assert all(length % 64 == 0 for length in lengths)
+    # Every step stays within one sequence of the token budget.
+    assert all(4096 - context_length < batch_size * context_length <= 4096 for batch_size, context_length in shapes)
+
+    dataset = np.arange(10_000, dtype=np.uint16)
+    sampler = BatchSampler(len(dataset), schedule.max_context_length, seed=0)
+    for step in [0, 50, 120]:
+        x, y = get_budget_batch(dataset, schedule, step, "cpu", sampler=sampler)
+        assert x.shape == y.shape == schedule(step)
+        assert torch.equal(x + 1, y)
+    assert sampler.samples_seen == sum(schedule.batch_size(step) for step in [0, 50, 120])
+
+    # In shuffle mode a short-context step reads consecutive windows of each max-length slot.
+    sampler = BatchSampler(len(dataset), schedule.max_context_length, seed=0, shuffle=True)
+    x, _ = get_budget_batch(dataset, schedule, 0, "cpu", sampler=sampler)
+    assert torch.equal(x[1:8, 0], x[0, 0] + 64 * torch.arange(1, 8))
+    assert sampler.samples_seen == schedule.batch_size(0) // 8
+
+
+def _gpt2_tokenizer(special_tokens):
+    return Tokenizer.from_files(FIXTURES_PATH / "gpt2_vocab.json", FIXTURES_PATH / "gpt2_merges.txt", special_tokens)
+
+
+def test_encode_file_matches_encode(tmp_path):
+    tokenizer = _gpt2_tokenizer(["<|endoftext|>"])
+    with open(FIXTURES_PATH / "tinystories_sample.txt", "rb") as f:
+        corpus_contents = f.read()
+    input_path = tmp_path / "corpus.txt"
+    input_path.write_bytes(corpus_contents * 3)
+
+    # A tiny chunk_size forces the file to be split into many tasks.
+    ids = encode_file(tokenizer, input_path, tmp_path / "corpus.bin", num_processes=2, chunk_size=1024)
+    assert ids.dtype == np.uint16
+    assert ids.tolist() == tokenizer.encode((corpus_contents * 3).decode("utf-8"))
+
+
+def test_encode_file_with_overlapping_special_tokens(tmp_path):
+    special_tokens = ["<|endoftext|>", "<|endoftext|><|endoftext|>"]
+    tokenizer = _gpt2_tokenizer(special_tokens)
+    with open(FIXTURES_PATH / "tinystories_sample.txt") as f:
+        documents = f.read().split("<|endoftext|>")
+    # Chunks must not start at the second half of a doubled <|endoftext|>
+    corpus_contents = "".join(doc + "<|endoftext|>" * (1 + i % 3) for i, doc in enumerate(documents * 3))
+    input_path = tmp_path / "corpus.txt"
+    input_path.write_text(corpus_contents)
+
+    ids = encode_file(tokenizer, input_path, tmp_path / "corpus.bin", num_processes=2, chunk_size=256)
+    assert ids.tolist() == tokenizer.encode(corpus_contents)
+    # TextBatchLoader encodes its chunks independently too
+    data = input_path.read_bytes()
+    loader = TextBatchLoader(tokenizer, input_path, batch_size=1, context_length=8, num_workers=0, chunk_size=256)
+    assert len(loader.tasks) > 1
+    chunk_ids = [tokenizer.encode(data[start:end].decode("utf-8")) for _, start, end in loader.tasks]
+    assert [i for ids in chunk_ids for i in ids] == ids.tolist()
+
+
+def test_encode_file_writes_shard_with_document_index(tmp_path):
+    tokenizer = _gpt2_tokenizer(["<|endoftext|>"])
+    with open(FIXTURES_PATH / "tinystories_sample.txt", "rb") as f:
+        corpus_contents = f.read()
+    input_path = tmp_path / "corpus.txt"
+    input_path.write_bytes(corpus_contents * 3)
+    encode_file(tokenizer, input_path, tmp_path / "corpus.bin", num_processes=2, chunk_size=1024)
+
+    tokens = load_tokens(tmp_path / "corpus.bin", fingerprint=tokenizer.fingerprint())
+    doc_starts = load_document_starts(tmp_path / "corpus.bin", eot_token_id=50256)
+    assert tokens.dtype == np.uint16
+    np.testing.assert_array_equal(doc_starts, document_starts(np.asarray(tokens), 50256))
+    assert len(doc_starts) == corpus_contents.count(b"<|endoftext|>") * 3 + 1
+
+    other = _gpt2_tokenizer(["<|endoftext|>", "<|pad|>"])
+    with pytest.raises(ValueError, match="different tokenizer"):
+        load_tokens(tmp_path / "corpus.bin", fingerprint=other.fingerprint())
+    with pytest.raises(ValueError, match="different tokenizer"):
+        MixtureDataset([(tmp_path / "corpus.bin", 1.0, "uint16")], fingerprint=other.fingerprint())
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_text_batch_loader_covers_corpus(tmp_path, num_workers):
+    tokenizer = _gpt2_tokenizer(["<|endoftext|>"])
+    with open(FIXTURES_PATH / "tinystories_sample.txt", "rb") as f:
+        corpus_contents = f.read()
+    input_path = tmp_path / "corpus.txt"
+    corpus_contents *= 2
+    input_path.write_bytes(corpus_contents)
+    context_length = 32
+    loader = TextBatchLoader(
+        tokenizer,
+        input_path,
+        batch_size=1,
+        context_length=context_length,
+        num_workers=num_workers,
+        shuffle_buffer_size=16,
+        chunk_size=2048,
+        num_epochs=1,
+    )
+    assert len(loader.tasks) > 2
+
+    expected = []
+    for _, start, end in loader.tasks:
+        ids = tokenizer.encode(corpus_contents[start:end].decode("utf-8"))
+        for i in range(0, len(ids) - context_length, context_length):
+            expected.append(tuple(ids[i : i + context_length + 1]))
+
+    windows = []
+    for x, y in loader:
+        assert x.shape == y.shape == (1, context_length)
+        assert torch.equal(x[0, 1:], y[0, :-1])
+        windows.append(tuple(x[0].tolist()) + (int(y[0, -1]),))
+    assert sorted(windows) == sorted(expected)
+    # The shuffle buffer mixes windows from different chunks.
+    assert windows != expected
+
+
+def test_split_special_token_must_be_special(tmp_path):
+    tokenizer = _gpt2_tokenizer(["<|endoftext|>"])
+    input_path = tmp_path / "corpus.txt"
+    input_path.write_text("Hello<|doc|>world<|endoftext|>")
+    with pytest.raises(ValueError, match="must be a special token"):
+        encode_file(tokenizer, input_path, tmp_path / "corpus.bin", split_special_token="<|doc|>")
+    with pytest.raises(ValueError, match="must be a special token"):
+        TextBatchLoader(tokenizer, input_path, batch_size=1, context_length=4, split_special_token="<|doc|>")
@@ -86,3 +86,10 @@ def test_train_bpe_special_tokens(snapshot):
             "merges": merges,
         },
     )
+
+
+def test_train_bpe_parallel_matches_serial():
+    input_path = FIXTURES_PATH / "tinystories_sample.txt"
+    serial = run_train_bpe(input_path=input_path, vocab_size=400, special_tokens=["<|endoftext|>"])
+    parallel = run_train_bpe(input_path=input_path, vocab_size=400, special_tokens=["<|endoftext|>"], num_processes=2)
+    assert parallel == serial